@@ -3,7 +3,8 @@ from adminsortable2.admin import SortableAdminMixin
 from django.contrib import admin
 from django.shortcuts import redirect
 
-from .models import ServerMember, Broadcast, Masternode, MasternodeWithdraw, Unstaking, UserNode, MasternodeBalanceLog
+from .models import ServerMember, Broadcast, Masternode, MasternodeWithdraw, Unstaking, UserNode, MasternodeBalanceLog, \
+    Notification, LedgerEntry, MasternodeBalanceDaily, Candle
 
 
 @admin.register(ServerMember)
@@ -51,4 +52,43 @@ class MasternodeBalanceLog(admin.ModelAdmin):
     ordering = '-datetime',
     list_display = 'member', 'delta', 'balance', 'datetime',
     search_fields = 'member__name', 'member__pk',
+    raw_id_fields = 'member',
+    list_select_related = 'member',
+    show_full_result_count = False
     date_hierarchy = 'datetime'
+
+
+@admin.register(MasternodeBalanceDaily)
+class MasternodeBalanceDailyAdmin(admin.ModelAdmin):
+    ordering = '-day',
+    list_display = 'member', 'day', 'delta_sum', 'balance', 'entries',
+    search_fields = 'member__name', 'member__pk',
+    raw_id_fields = 'member',
+    list_select_related = 'member',
+    date_hierarchy = 'day'
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    ordering = '-id',
+    list_display = 'id', 'member', 'channel', 'created_at', 'attempts', 'sent',
+    list_filter = 'sent',
+    raw_id_fields = 'member',
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    ordering = '-datetime',
+    list_display = 'datetime', 'kind', 'member', 'account', 'delta', 'balance_after', 'reference',
+    list_filter = 'kind', 'account',
+    search_fields = 'member__name', 'member__pk', 'reference', 'entry',
+    raw_id_fields = 'member',
+    date_hierarchy = 'datetime'
+
+
+@admin.register(Candle)
+class CandleAdmin(admin.ModelAdmin):
+    ordering = '-start',
+    list_display = 'start', 'interval', 'open', 'high', 'low', 'close', 'volume', 'trades',
+    list_filter = 'interval',
+    date_hierarchy = 'start'
@@ -14,8 +14,8 @@ from django.utils.timezone import now
 from dynamic_preferences.registries import global_preferences_registry
 
 from app.models import ServerMember, Unstaking, MNInvestTask, MasternodeWithdraw, MasternodeBalanceLog, \
-    TrackedMasternode
-from evosbot.utils import client, fd, staking_pool_address, tx_logger, staking_client, masternode_client, bitcoin_client
+    TrackedMasternode, LedgerEntry
+from evosbot.utils import client, fd, staking_pool_address, staking_client, masternode_client, bitcoin_client
 
 global_preferences = global_preferences_registry.manager()
 
@@ -57,23 +57,28 @@ def get_status(sm: ServerMember, discord=True):
 
 def process_staking(sm: ServerMember, amount: Decimal):
     with transaction.atomic():
-        sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
         if sm.balance < amount:
             raise SendMessage('Insufficient funds')
         if amount <= client.minimal_spend():
             raise SendMessage('Amount should be more than {}'.format(fd(client.minimal_spend())))
         amount_without_fee = amount - global_preferences['general__transaction_commission']
+        # the funds are taken before sending, a failed send rolls it back
+        deltas = {'balance': -amount}
+        if sm.is_staking_pool:
+            deltas['staking_pool_amount'] = amount_without_fee
+        if not sm.adjust(**deltas):
+            raise SendMessage('Insufficient funds')
         try:
             if sm.is_staking_pool:
                 txid = client.send_funds(staking_pool_address(), amount_without_fee)
-                sm.staking_pool_amount += amount_without_fee
             else:
                 txid = client.send_funds(sm.staking_wallet_address, amount_without_fee)
         except RuntimeError:
             raise SendMessage('Operation is currently unavailable, please try later')
-        sm.balance -= amount
-        sm.save()
-        tx_logger.warning('STAKING,{},-{:.8f}'.format(sm, amount))
+        legs = [(sm, 'balance', -amount)]
+        if sm.is_staking_pool:
+            legs.append((sm, 'staking_pool_amount', amount_without_fee))
+        LedgerEntry.post('STAKING', *legs, reference=txid)
     raise SendMessage('Started staking of {}'.format(fd(amount)))
 
 
@@ -105,7 +110,7 @@ def process_stakingmode(sm: ServerMember, mode: str):
                 not sm.is_staking_pool and (sm.staking_balance or sm.pending_unstaking)):
             raise SendMessage('Could not toggle mode when there are staking coins or pending unstakings')
         sm.is_staking_pool = mode == 'pool'
-        sm.save()
+        sm.save(update_fields=('is_staking_pool',))
     raise SendMessage('Staking mode was toggled')
 
 
@@ -114,7 +119,6 @@ def process_mninvest(sm: ServerMember, amount: Decimal):
         pr = MNInvestTask.objects.filter(member=sm, processed=False).first()
         if pr:
             raise SendMessage('You already have a pending invest request for {} SOVE'.format(fd(pr.amount)))
-        sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
         if sm.balance < amount:
             raise SendMessage('Insufficient funds')
         if amount <= client.minimal_spend():
@@ -123,28 +127,28 @@ def process_mninvest(sm: ServerMember, amount: Decimal):
         if sm.masternode_balance < 2 and amount < 10:
             raise SendMessage('Minimal invest amount is {} SOVE'.format(fd(10)))
         amount_without_fee = amount - global_preferences['general__transaction_commission']
-        sm.balance -= amount
-        sm.save()
-        tx_logger.warning('MNINVEST,{},-{:.8f}'.format(sm, amount))
+        if not sm.adjust(balance=-amount):
+            raise SendMessage('Insufficient funds')
+        LedgerEntry.post('MNINVEST', (sm, 'balance', -amount))
         MNInvestTask.objects.create(member=sm, amount=amount, amount_without_fee=amount_without_fee)
     raise SendMessage('Invest request was queued')
 
 
 def process_mnwithdraw(sm: ServerMember, amount: Decimal):
     with transaction.atomic():
-        sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
         if sm.masternode_balance < amount:
             raise SendMessage('Insufficient funds')
         if amount <= masternode_client.minimal_spend():
             raise SendMessage('Amount should be more than {}'.format(fd(masternode_client.minimal_spend())))
+        if not sm.adjust(masternode_balance=-amount):
+            raise SendMessage('Insufficient funds')
         MasternodeWithdraw.objects.create(
             member=sm,
             amount=amount,
             fulfill_at=now() + timedelta(hours=randint(6, 24))
         )
-        sm.masternode_balance -= amount
-        sm.save()
         MasternodeBalanceLog.objects.create(member=sm, balance=sm.masternode_balance, delta=-amount)
+        LedgerEntry.post('MNWITHDRAW', (sm, 'masternode_balance', -amount))
     raise SendMessage('Withdraw from masternode request for {} was created'.format(fd(amount)))
 
 
@@ -158,7 +162,6 @@ def process_send(sm: ServerMember, to: Union[ServerMember, str], amount: Decimal
                 raise SendMessage('One-time password is either incorrect or not provided.\n'
                                   'Usage: `$send <@mention or wallet address> amount [2fa code]`')
         logging.warning('checked otp')
-        sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
         if sm.balance < amount:
             raise SendMessage('Insufficient funds')
         logging.warning('checked balance')
@@ -166,13 +169,10 @@ def process_send(sm: ServerMember, to: Union[ServerMember, str], amount: Decimal
             raise SendMessage('Amount should be more than {}'.format(fd(client.minimal_spend())))
         logging.warning('checked minimal limit')
         if isinstance(to, ServerMember):
-            sm.balance -= amount
-            sm.save()
-            tx_logger.warning('SEND,{},-{:.8f}'.format(sm, amount))
-            to_member = ServerMember.objects.select_for_update().get(pk=to.pk)
-            to_member.balance += amount
-            to_member.save()
-            tx_logger.warning('SEND,{},+{:.8f}'.format(to_member, amount))
+            if not sm.adjust(balance=-amount):
+                raise SendMessage('Insufficient funds')
+            to.adjust(balance=amount)
+            LedgerEntry.post('SEND', (sm, 'balance', -amount), (to, 'balance', amount))
             if tg:
                 result = '{} SOVE sent to @{}\'s wallet'.format(fd(amount), to.username)
             else:
@@ -181,35 +181,33 @@ def process_send(sm: ServerMember, to: Union[ServerMember, str], amount: Decimal
             logging.warning('validating address')
             if not client.validate_address(to):
                 raise SendMessage('Specified address is invalid')
+            # the funds are taken before sending, any failure rolls it back
+            if not sm.adjust(balance=-amount):
+                raise SendMessage('Insufficient funds')
             try:
                 logging.warning('sending funds')
                 txid = client.send_funds(to, amount - global_preferences['general__transaction_commission'])
-                logging.warning('changing balance')
-                sm.balance -= amount
-                sm.save()
-                tx_logger.warning('SEND,{},-{:.8f},{}'.format(sm, amount, to))
-                result = '{} SOVE sent to `{}`\nTXID: `{}`'.format(fd(amount), to, txid)
-            except RuntimeError:
-                traceback.print_exc()
-                raise SendMessage('Operation is currently unavailable, please try later')
             except:
                 traceback.print_exc()
+                raise SendMessage('Operation is currently unavailable, please try later')
+            LedgerEntry.post('SEND', (sm, 'balance', -amount), reference=to)
+            result = '{} SOVE sent to `{}`\nTXID: `{}`'.format(fd(amount), to, txid)
     raise SendMessage(result)
 
 
 def process_sendbtc(sm: ServerMember, address: str, amount: Decimal):
     with transaction.atomic():
-        sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
         if sm.bitcoin_balance < amount:
             raise SendMessage('Insufficient balance')
         if not bitcoin_client.validate_address(address):
             raise SendMessage('Invalid address')
+        if not sm.adjust(bitcoin_balance=-amount):
+            raise SendMessage('Insufficient balance')
         try:
             txid = bitcoin_client.api.sendtoaddress(address, amount, None, None, True)
         except:
             raise SendMessage('Operation is currently unavailable, please try later')
-        sm.bitcoin_balance -= amount
-        sm.save()
+        LedgerEntry.post('SENDBTC', (sm, 'bitcoin_balance', -amount), reference=address)
     raise SendMessage('txid: `{}`'.format(txid))
 
 
@@ -226,7 +224,7 @@ def process_otp_setup(sm: ServerMember, send_message):
                            'You also can use text secret: `{}`'.format(sm.otp_secret),
                            fpath)
         sm.otp_qr_message_id = mid
-        sm.save()
+        sm.save(update_fields=('otp_secret', 'otp_qr_message_id'))
 
 
 def process_otp_confirm(sm: ServerMember, otp: str, delete_message):
@@ -238,7 +236,7 @@ def process_otp_confirm(sm: ServerMember, otp: str, delete_message):
         raise SendMessage('Provided one-time password is invalid')
     delete_message(sm.otp_qr_message_id)
     sm.otp_active = True
-    sm.save()
+    sm.save(update_fields=('otp_active',))
     raise SendMessage('2FA was successfully activated.\nCurrent threshold: {} SOVE\n'
                       'Use `2fa threshold <NEW_VALUE> <2fa code>` command to change it.\n\n'
                       'QR code was removed for security purposes.'.format(fd(sm.otp_threshold)))
@@ -252,7 +250,7 @@ def process_otp_threshold(sm: ServerMember, value: Decimal, otp: str):
     if value < 0:
         raise SendMessage('New threshold value should be positive')
     sm.otp_threshold = value
-    sm.save()
+    sm.save(update_fields=('otp_threshold',))
     raise SendMessage('2FA threshold was successfully changed')
 
 
@@ -263,16 +261,18 @@ def process_otp_disable(sm: ServerMember, otp: str):
         raise SendMessage('Provided one-time password is invalid')
     sm.otp_secret = None
     sm.otp_active = False
-    sm.save()
+    sm.save(update_fields=('otp_secret', 'otp_active'))
     raise SendMessage('2FA was successfully disabled')
 
 
-def trackmn(sm: ServerMember, addr: str):
+def trackmn(sm: ServerMember, addr: str, masternodes: list = None):
     if sm.tracked_masternodes.count() == 20:
         raise SendMessage('You cannot have more than 20 tracked masternodes')
     if sm.tracked_masternodes.filter(addr=addr).count():
         raise SendMessage('You are already tracking this masternode')
-    mns = {m['addr']: m for m in client.api.masternode('list')}
+    if masternodes is None:
+        masternodes = client.api.masternode('list')
+    mns = {m['addr']: m for m in masternodes}
     mn = mns.get(addr)
     if not mn:
         raise SendMessage('Masternode was not found')
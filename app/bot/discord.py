@@ -1,7 +1,6 @@
 import asyncio
 import io
 import itertools
-import json
 import logging
 import math
 import os
@@ -12,9 +11,10 @@ import tempfile
 import threading
 import traceback
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from decimal import Decimal, getcontext
-from random import randint, sample
+from random import sample
 from secrets import randbelow
 from typing import Union
 
@@ -27,22 +27,28 @@ from discord.ext.commands import Context, DefaultHelpCommand, CommandError, Comm
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.template.loader import render_to_string
+from django.db.models import F
 from django.utils.timezone import now
-from django.db.models import Sum, F
 from dynamic_preferences.registries import global_preferences_registry
 from weasyprint import HTML
 
 from app.bot import get_status, process_staking, SendMessage, process_unstaking, process_stakingmode, process_mninvest, \
     process_mnwithdraw, process_sendbtc, process_send, process_otp_confirm, process_otp_setup, process_otp_threshold, \
     process_otp_disable, trackmn, untrackmn, trackmnlist
+from app import presence
+from app.exchange import get_depth
+from app.xp import discord_xp, XP_FLUSH_INTERVAL
 from app.models import ServerMember, Broadcast, ServerInvite, Unstaking, MasternodeWithdraw, TradeOrder, LotteryTicket, \
-    UserNode, Masternode, OrderLog, MasternodeBalanceLog, MNInvestTask, TrackedMasternode, AirdropTask
+    UserNode, Masternode, OrderLog, Candle, MasternodeBalanceLog, MNInvestTask, TrackedMasternode, AirdropTask, LedgerEntry
 from evosbot.utils import client, staking_client, staking_pool_client, staking_pool_address, masternode_client, \
-    masternode_address, get_masternode_price, usernode_client, bitcoin_client, get_rewards, send_stats, tx_logger, fd, \
-    send_discord_message
+    masternode_address, get_masternode_price_async, usernode_client, bitcoin_client, get_rewards, send_stats, \
+    fd, send_discord_message, set_role_snapshots
 
 global_preferences = global_preferences_registry.manager()
 
+# redis writes for presence and role snapshots run off the event loop, one thread keeps them in event order
+presence_executor = ThreadPoolExecutor(1)
+
 
 class CustomHelpCommand(DefaultHelpCommand):
     async def filter_commands(self, commands, *, sort=False, key=None):
@@ -108,25 +114,51 @@ class BackgroundTasks(commands.Cog):
         self.update_online.start()
         self.stats.start()
         self.activity.start()
+        self.role_snapshots.start()
+        self.flush_xp.start()
 
     def cog_unload(self):
         self.update_online.cancel()
         self.stats.cancel()
         self.activity.cancel()
+        self.role_snapshots.cancel()
+        self.flush_xp.cancel()
 
-    @tasks.loop(seconds=5)
+    @tasks.loop(minutes=5)
     async def update_online(self):
+        # presence is maintained from member events, this only corrects drift
         try:
             guild = bot.get_guild(global_preferences['general__guild_id'])
-            online_users = [m.id for m in guild.members if m.status != Status.offline and not m.bot]
-            with open('/tmp/evos_online.json', 'w') as f:
-                json.dump(online_users, f)
-            online_users_dict = {m.id: [str(r.id) for r in m.roles]
-                                 for m in guild.members if m.status != Status.offline and not m.bot}
-            with open('/tmp/evos_online_with_roles.json', 'w') as f:
-                json.dump(online_users_dict, f)
+            members = [m for m in guild.members if not m.bot]
+            await bot.loop.run_in_executor(presence_executor, presence.resync,
+                                           [m.id for m in members if m.status != Status.offline],
+                                           {m.id: member_role_ids(m) for m in members})
         except:
-            pass
+            logging.exception('Could not resync presence')
+
+    @update_online.before_loop
+    async def before_update_online(self):
+        await bot.wait_until_ready()
+
+    @tasks.loop(minutes=10)
+    async def role_snapshots(self):
+        try:
+            guild = bot.get_guild(global_preferences['general__guild_id'])
+            await bot.loop.run_in_executor(presence_executor, set_role_snapshots,
+                                           {m.id: member_role_ids(m) for m in guild.members if not m.bot})
+        except:
+            logging.exception('Could not store role snapshots')
+
+    @role_snapshots.before_loop
+    async def before_role_snapshots(self):
+        await bot.wait_until_ready()
+
+    @tasks.loop(seconds=XP_FLUSH_INTERVAL)
+    async def flush_xp(self):
+        try:
+            await bot.loop.run_in_executor(None, discord_xp.flush)
+        except:
+            logging.exception('Could not flush xp')
 
     @tasks.loop(seconds=global_preferences['general__stats_interval'])
     async def stats(self):
@@ -149,11 +181,10 @@ class BackgroundTasks(commands.Cog):
             #            elif activity_index == 5:
             #                activity_text = 'CB 24h vol: {} BTC'.format(fd(global_preferences['internal__cryptobridge_volume']))
             elif activity_index == 4:
-                guild = bot.get_guild(global_preferences['general__guild_id'])
-                online_count = len([m.id for m in guild.members if m.status != Status.offline and not m.bot])
-                activity_text = 'Online: {} users'.format(online_count)
+                activity_text = 'Online: {} users'.format(
+                    await bot.loop.run_in_executor(presence_executor, presence.online_count))
             elif activity_index == 5:
-                activity_text = 'Block height: {}'.format(client.api.getblockcount())
+                activity_text = 'Block height: {}'.format(await client.aio.getblockcount())
             else:
                 activity_text = '---'
             self.activity_index = (activity_index + 1) % 6
@@ -164,6 +195,31 @@ class BackgroundTasks(commands.Cog):
             pass
 
 
+def member_role_ids(member: Member):
+    return {str(r.id) for r in member.roles if not r.is_default()}
+
+
+@bot.event
+async def on_member_update(before: Member, after: Member):
+    if after.bot:
+        return
+    if before.roles != after.roles:
+        roles_before, roles_after = member_role_ids(before), member_role_ids(after)
+        await bot.loop.run_in_executor(presence_executor, set_role_snapshots, {after.id: roles_after})
+        await bot.loop.run_in_executor(presence_executor, presence.update_roles,
+                                       after.id, roles_before - roles_after, roles_after - roles_before)
+    if (before.status == Status.offline) != (after.status == Status.offline):
+        await bot.loop.run_in_executor(presence_executor, presence.set_online,
+                                       after.id, after.status != Status.offline)
+
+
+@bot.event
+async def on_member_remove(member: Member):
+    if not member.bot:
+        await bot.loop.run_in_executor(presence_executor, presence.remove_member,
+                                       member.id, member_role_ids(member))
+
+
 @bot.event
 async def on_ready():
     print('Logged on as', bot.user)
@@ -274,11 +330,7 @@ async def on_message(message: Message):
         return
     if len(message.clean_content) < 50:
         return
-    sm = ServerMember.from_member(message.author)
-    if not sm.last_message or now() - sm.last_message > timedelta(seconds=60 + randint(0, 60)):
-        sm.xp += 1
-        sm.last_message = now()
-        sm.save()
+    await bot.loop.run_in_executor(None, discord_xp.award, message.author)
 
 
 class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
@@ -301,9 +353,10 @@ class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
             return
         sm.xp += Decimal('.25')
         sm.activity_counter += 1
-        sm.save()
+        ServerMember.objects.filter(pk=sm.pk).update(xp=F('xp') + Decimal('.25'),
+                                                     activity_counter=F('activity_counter') + 1)
         author.last_like = now()
-        author.save()
+        author.save(update_fields=('last_like',))
         await ctx.send('{} increased {}\'s XP by 0.25 and activity by 1 minute, current value XP: {}, activity: {} minutes'.format(ctx.author.mention, mention.mention, sm.xp, sm.activity_counter))
 
     @command(help='To show your antipathy', order_index=2)
@@ -326,9 +379,9 @@ class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
         if sm.xp - Decimal('.25') < 0:
             return await ctx.send('Cannot decrease XP below 0')
         sm.xp -= Decimal('.25')
-        sm.save()
+        ServerMember.objects.filter(pk=sm.pk).update(xp=F('xp') - Decimal('.25'))
         author.last_dislike = now()
-        author.save()
+        author.save(update_fields=('last_dislike',))
         await ctx.send('{} decreased {}\'s XP by 0.25, current value: {}'.format(ctx.author.mention, mention.mention, sm.xp))
 
     @command(help='Decrease XP by 1, __mods_only__', hidden=True, order_index=3)
@@ -339,7 +392,7 @@ class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
         if sm.xp - Decimal('1.0') < 0:
             return await ctx.send('Cannot decrease XP below 0')
         sm.xp -= Decimal('1.0')
-        sm.save()
+        ServerMember.objects.filter(pk=sm.pk).update(xp=F('xp') - Decimal('1.0'))
         await ctx.send('Mod {} decreased {}\'s XP by 1, current value: {}'.format(ctx.author.mention, mention.mention, sm.xp))
 
     @command(help='Check user status __staff_only__', hidden=True, order_index=4)
@@ -379,62 +432,54 @@ class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
         if not (0 < users_cnt <= 50):
             return await ctx.send('Users count should be in interval 1..50')
 
+        sm = ServerMember.from_member(ctx.author)
+        if sm.balance < amount:
+            return await ctx.send('Insufficient funds')
+        guild = bot.get_guild(global_preferences['general__guild_id'])  # type: Guild
+        online_members = list(filter(lambda m: m.status != Status.offline and not m.bot and m.id != sm.pk,
+                                     guild.members))
+        if role:
+            online_members = list(filter(lambda m: m.mentioned_in(ctx.message), online_members))
+        users_cnt = min(users_cnt, len(online_members)) or len(online_members)
+        if not users_cnt:
+            return await ctx.send('There\'s no one on this server to rain tokens on')
+        selected_users = sample(online_members, k=users_cnt)
+        reward = amount / users_cnt
+        if reward <= 0:
+            return await ctx.send('Amount is too small')
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            if sm.balance < amount:
+            if not sm.adjust(balance=-reward * users_cnt):
                 return await ctx.send('Insufficient funds')
-            guild = bot.get_guild(global_preferences['general__guild_id'])  # type: Guild
-            online_members = list(filter(lambda m: m.status != Status.offline and not m.bot and m.id != sm.pk,
-                                         guild.members))
-            if role:
-                online_members = list(filter(lambda m: m.mentioned_in(ctx.message), online_members))
-            users_cnt = min(users_cnt, len(online_members)) or len(online_members)
-            if not users_cnt:
-                return await ctx.send('There\'s no one on this server to rain tokens on')
-            selected_users = sample(online_members, k=users_cnt)
-            reward = amount / users_cnt
-            if reward <= 0:
-                return await ctx.send('Amount is too small')
-            sm.balance -= reward * users_cnt
-            sm.save()
-            tx_logger.warning('RAIN,{},-{:.8f}'.format(sm, amount))
-
-            def _():
-                tasks = []
-                for user in selected_users:
-                    with transaction.atomic():
-                        member = ServerMember.from_member(user)
-                        tasks.append(AirdropTask(member=member, amount=reward, is_rain=True))
-                AirdropTask.objects.bulk_create(tasks)
-                sm.send_message('Rain was queued')
-
-            thread = threading.Thread(target=_)
-            thread.start()
+            LedgerEntry.post('RAIN', (sm, 'balance', -reward * users_cnt))
+
+        def _():
+            tasks = []
+            for user in selected_users:
+                tasks.append(AirdropTask(member_id=ServerMember.ensure(user), amount=reward, is_rain=True))
+            AirdropTask.objects.bulk_create(tasks)
+            sm.send_message('Rain was queued')
+
+        thread = threading.Thread(target=_)
+        thread.start()
 
     @command(help='Play a lottery', order_index=8)
     async def lottery(self, ctx: Context, value: int):
         if ctx.channel.id != global_preferences['games__games_channel_id']:
             return await ctx.send('This command only can be used in the #games channel')
 
+        ticket_price = global_preferences['games__lottery_ticket_price']
+        if value < 0 or value > 255:
+            return await ctx.send('Value must be between 0 and 255')
+        sm = ServerMember.from_member(ctx.author)
         with transaction.atomic():
-            ticket_price = global_preferences['games__lottery_ticket_price']
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-
-            if value < 0 or value > 255:
-                return await ctx.send('Value must be between 0 and 255')
-            if sm.balance < ticket_price:
+            if not sm.adjust(balance=-ticket_price):
                 return await ctx.send('Insufficient funds')
-
-            sm.balance -= ticket_price
-            sm.save()
-            tx_logger.warning('LOTTERY,{},-{:.8f}'.format(sm, ticket_price))
+            LedgerEntry.post('LOTTERY', (sm, 'balance', -ticket_price))
             LotteryTicket.objects.create(member=sm, value=value)
             global_preferences['internal__lottery_jackpot'] += ticket_price * Decimal('.95')
-            await ctx.send('Ticket was successfully bought. Jackpot: {}'.format(
-                fd(global_preferences['internal__lottery_jackpot'])
-            ))
+        await ctx.send('Ticket was successfully bought. Jackpot: {}'.format(
+            fd(global_preferences['internal__lottery_jackpot'])
+        ))
 
     @command(help='Play dice', order_index=9)
     async def dice(self, ctx: Context, amount: Decimal):
@@ -445,51 +490,45 @@ class ServerCommands(commands.Cog, name='Server commands (starts with $)'):
             html = render_to_string('dice.html', {'dice1': dice1, 'dice2': dice2, 'result': result})
             return io.BytesIO(HTML(string=html).write_png())
 
+        if amount < Decimal('.05'):
+            return await ctx.send('Minumum bet amount is: 0.05 SOVE')
+        sm = ServerMember.from_member(ctx.author)
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            if amount > sm.balance:
+            if not sm.adjust(balance=-amount):
                 return await ctx.send('Insufficient funds')
-            if amount < Decimal('.05'):
-                return await ctx.send('Minumum bet amount is: 0.05 SOVE')
-
-            sm.balance -= amount
-            sm.save()
-            tx_logger.warning('DICE,{},-{:.8f}'.format(sm, amount))
+            LedgerEntry.post('DICE', (sm, 'balance', -amount))
             global_preferences['internal__dice_jackpot'] += amount * Decimal('.95')
             dice1, dice2 = randbelow(6) + 1, randbelow(6) + 1
             if dice1 + dice2 != 10:
                 message = 'You lost! Jackpot is: {} SOVE'.format(fd(global_preferences['internal__dice_jackpot']))
-                return await ctx.send(file=File(generate_image(dice1, dice2, message), 'dice.png'))
-            win_amount = min(global_preferences['internal__dice_jackpot'], amount * 10)
-            if not randbelow(50):
-                win_amount = global_preferences['internal__dice_jackpot']
-
-            global_preferences['internal__dice_jackpot'] -= win_amount
-            sm.balance += win_amount
-            sm.save()
-            tx_logger.warning('DICE,{},+{:.8f}'.format(sm, win_amount))
-            message = 'You won {} SOVE!'.format(fd(win_amount))
-            await ctx.send(file=File(generate_image(dice1, dice2, message), 'dice.png'))
-            if not global_preferences['internal__dice_jackpot'] and \
-                    global_preferences['general__feeder_balance'] >= global_preferences['games__dice_jackpot_refill']:
-                global_preferences['internal__dice_jackpot'] = global_preferences['games__dice_jackpot_refill']
-                global_preferences['general__feeder_balance'] -= global_preferences['games__dice_jackpot_refill']
+            else:
+                win_amount = min(global_preferences['internal__dice_jackpot'], amount * 10)
+                if not randbelow(50):
+                    win_amount = global_preferences['internal__dice_jackpot']
+
+                global_preferences['internal__dice_jackpot'] -= win_amount
+                sm.adjust(balance=win_amount)
+                LedgerEntry.post('DICE', (sm, 'balance', win_amount))
+                message = 'You won {} SOVE!'.format(fd(win_amount))
+                if not global_preferences['internal__dice_jackpot'] and \
+                        global_preferences['general__feeder_balance'] >= global_preferences['games__dice_jackpot_refill']:
+                    global_preferences['internal__dice_jackpot'] = global_preferences['games__dice_jackpot_refill']
+                    global_preferences['general__feeder_balance'] -= global_preferences['games__dice_jackpot_refill']
+        await ctx.send(file=File(generate_image(dice1, dice2, message), 'dice.png'))
 
     @command(help='Deposit to bounty/airdrops address (Help the community!)', hidden=True, order_index=10)
     async def feeder_deposit(self, ctx: Context, amount: Decimal):
+        if amount <= 0:
+            return await ctx.send('Amount should be positive')
+        sm = ServerMember.from_member(ctx.author)
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            if amount > sm.balance:
+            if not sm.adjust(balance=-amount):
                 return await ctx.send('Insufficient funds')
-            sm.balance -= amount
-            sm.save()
             global_preferences['general__feeder_balance'] += amount
-            await ctx.send('Feeder deposit was performed successfully, current balance: {}'.format(
-                fd(global_preferences['general__feeder_balance'])
-            ))
-            tx_logger.warning('FEEDER,{},-{:.8f}'.format(sm, amount))
+            LedgerEntry.post('FEEDER', (sm, 'balance', -amount))
+        await ctx.send('Feeder deposit was performed successfully, current balance: {}'.format(
+            fd(global_preferences['general__feeder_balance'])
+        ))
 
     @command(hidden=True, order_index=11)
     async def stats_S1(self, ctx: Context):
@@ -514,22 +553,22 @@ class PrivateCommands(commands.Cog, name='Private commands'):
                            'if your Discord account has been disabled or deleted', order_index=14)
     @commands.dm_only()
     async def rescue(self, ctx: Context):
-        sm = ServerMember.from_member(ctx.author)
-        send_discord_message(global_preferences['general__rescue_channel'], 'User: <@{}> got rescue code'.format(sm.pk))
-        await ctx.send(hashlib.scrypt(sm.id.to_bytes(8, byteorder='little'), salt=b'KL3982872uu2cjiOCz', n=16, r=1, p=1, dklen=16).hex())
+        member_id = ServerMember.ensure(ctx.author)
+        send_discord_message(global_preferences['general__rescue_channel'], 'User: <@{}> got rescue code'.format(member_id))
+        await ctx.send(hashlib.scrypt(member_id.to_bytes(8, byteorder='little'), salt=b'KL3982872uu2cjiOCz', n=16, r=1, p=1, dklen=16).hex())
 
     @command(help='Show your Earn-by-Invite bounty status', hidden=True, order_index=15)
     @commands.dm_only()
     async def invite_S1(self, ctx: Context):
-        sm = ServerMember.from_member(ctx.author)
-        lvl1_referrals = ServerMember.objects.filter(referrer=sm).count()
-        lvl1_confirmed_referrals = ServerMember.objects.filter(referrer=sm,
+        member_id = ServerMember.ensure(ctx.author)
+        lvl1_referrals = ServerMember.objects.filter(referrer=member_id).count()
+        lvl1_confirmed_referrals = ServerMember.objects.filter(referrer=member_id,
                                                                rank__gt=ServerMember.Rank.BRAND_NEW).count()
-        lvl2_referrals = ServerMember.objects.filter(referrer__referrer=sm).count()
-        lvl2_confirmed_referrals = ServerMember.objects.filter(referrer__referrer=sm,
+        lvl2_referrals = ServerMember.objects.filter(referrer__referrer=member_id).count()
+        lvl2_confirmed_referrals = ServerMember.objects.filter(referrer__referrer=member_id,
                                                                rank__gt=ServerMember.Rank.BRAND_NEW).count()
-        lvl3_referrals = ServerMember.objects.filter(referrer__referrer__referrer=sm).count()
-        lvl3_confirmed_referrals = ServerMember.objects.filter(referrer__referrer__referrer=sm,
+        lvl3_referrals = ServerMember.objects.filter(referrer__referrer__referrer=member_id).count()
+        lvl3_confirmed_referrals = ServerMember.objects.filter(referrer__referrer__referrer=member_id,
                                                                rank__gt=ServerMember.Rank.BRAND_NEW).count()
         message = 'Level 1 referrals: {} (confirmed: {})\n' \
                   'Level 2 referrals: {} (confirmed: {})\n' \
@@ -598,74 +637,74 @@ class PrivateCommands(commands.Cog, name='Private commands'):
                            'ex. $buy 10 20000', order_index=21)
     @commands.dm_only()
     async def buy(self, ctx: Context, amount: Decimal, price: int):
+        sm = ServerMember.from_member(ctx.author)
+        price = Decimal(price) / 10**8
+        if sm.bitcoin_balance < amount * price:
+            return await ctx.send('Insufficient funds')
+        if amount <= 0 or price <= 0:
+            return await ctx.send('Amount and price should be positive')
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            price = Decimal(price) / 10**8
-            if sm.bitcoin_balance < amount * price:
+            if not sm.adjust(bitcoin_balance=-amount * price):
                 return await ctx.send('Insufficient funds')
-            if amount <= 0 or price <= 0:
-                return await ctx.send('Amount and price should be positive')
-            sm.bitcoin_balance -= amount * price
-            sm.save()
             to = TradeOrder.objects.create(
                 member=sm,
                 is_sell=False,
                 amount=amount,
                 btc_price=price
             )
-            await ctx.send('Order #{} was created'.format(to.pk))
-            to.try_execution()
+            LedgerEntry.post('BUY', (sm, 'bitcoin_balance', -amount * price), reference=to.pk)
+        await ctx.send('Order #{} was created'.format(to.pk))
 
     @command(help='Place an order to sell SOVE. sell <amount> <price_in_satoshis> '
                            'ex. $sell 5 30000', order_index=22)
     @commands.dm_only()
     async def sell(self, ctx: Context, amount: Decimal, price: int):
+        sm = ServerMember.from_member(ctx.author)
+        price = Decimal(price) / 10**8
+        if sm.balance < amount:
+            return await ctx.send('Insufficient funds')
+        if amount <= 0 or price <= 0:
+            return await ctx.send('Amount and price should be positive')
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            price = Decimal(price) / 10**8
-            if sm.balance < amount:
+            if not sm.adjust(balance=-amount):
                 return await ctx.send('Insufficient funds')
-            if amount <= 0 or price <= 0:
-                return await ctx.send('Amount and price should be positive')
-            sm.balance -= amount
-            sm.save()
-            tx_logger.warning('SELL,{},-{:.8f}'.format(sm, amount))
             to = TradeOrder.objects.create(
                 member=sm,
                 is_sell=True,
                 amount=amount,
                 btc_price=price
             )
-            await ctx.send('Order #{} was created'.format(to.pk))
-            to.try_execution()
+            LedgerEntry.post('SELL', (sm, 'balance', -amount), reference=to.pk)
+        await ctx.send('Order #{} was created'.format(to.pk))
 
     @command(help='Get up to 10 top orders and list your own', order_index=23)
     @commands.dm_only()
     async def orders(self, ctx: Context):
-        sm = ServerMember.from_member(ctx.author)
+        member_id = ServerMember.ensure(ctx.author)
 
-        sell_qs = TradeOrder.objects.filter(is_sell=True, amount__gt=0).values('btc_price')\
-            .annotate(amount=Sum('amount')).order_by('btc_price')
-        sell_total = sell_qs.aggregate(sum=Sum(F('amount') * F('btc_price')))['sum'] or 0
-        msg = ['```yaml', 'Sell orders (total {:.8f} BTC)'.format(sell_total)]
-        for o in sell_qs[:10]:
-            msg.append('- {:.8f} SOVE per {:.8f} BTC ({:.8f} BTC total)'.format(o['amount'], o['btc_price'], o['amount'] * o['btc_price']))
+        depth = get_depth()
+        msg = ['```yaml', 'Sell orders (total {:.8f} BTC)'.format(depth['sell_total'])]
+        for price, amount in depth['sell']:
+            msg.append('- {:.8f} SOVE per {:.8f} BTC ({:.8f} BTC total)'.format(amount, price, amount * price))
         msg += ['', '```']
         await ctx.send('\n'.join(msg))
 
-        buy_qs = TradeOrder.objects.filter(is_sell=False, amount__gt=0).values('btc_price')\
-            .annotate(amount=Sum('amount')).order_by('-btc_price')
-        buy_total = buy_qs.aggregate(sum=Sum(F('amount') * F('btc_price')))['sum'] or 0
-        msg = ['```diff', 'Buy orders (total {:.8f} BTC)'.format(buy_total)]
-        for o in buy_qs[:10]:
-            msg.append('- {:.8f} SOVE per {:.8f} BTC ({:.8f} BTC total)'.format(o['amount'], o['btc_price'], o['amount'] * o['btc_price']))
+        msg = ['```diff', 'Buy orders (total {:.8f} BTC)'.format(depth['buy_total'])]
+        for price, amount in depth['buy']:
+            msg.append('- {:.8f} SOVE per {:.8f} BTC ({:.8f} BTC total)'.format(amount, price, amount * price))
 
         msg += ['', '```']
         await ctx.send('\n'.join(msg))
 
-        msg = ['```', 'Last orders']
+        day = Candle.summary(now() - timedelta(1))
+        msg = ['```', 'Last 24 hours']
+        if day['volume']:
+            msg.append('- last price: {:.8f} BTC, high: {:.8f} BTC, low: {:.8f} BTC'.format(
+                Candle.last_price(), day['high'], day['low']))
+            msg.append('- volume: {:.8f} SOVE, {:.8f} BTC'.format(day['volume'], day['btc_volume']))
+        else:
+            msg.append('- no deals')
+        msg += ['', 'Last orders']
         for o in OrderLog.objects.order_by('-pk')[:10]:
             msg.append('- {} {} amount: {:.8f} SOVE, price: {:.8f} BTC, total: {:.8f} BTC'.format(
                 o.datetime.strftime('%Y-%m-%d %H:%M:%S'),
@@ -677,7 +716,7 @@ class PrivateCommands(commands.Cog, name='Private commands'):
         await ctx.send('\n'.join(msg))
 
         msg = ['```fix', 'Your orders']
-        for i, o in enumerate(TradeOrder.objects.filter(member=sm, amount__gt=0), 1):
+        for i, o in enumerate(TradeOrder.objects.filter(member_id=member_id, amount__gt=0), 1):
             msg.append('- #{}: {} {:.8f} SOVE per {:.8f} BTC ({:.8f} BTC total)'.format(
                 o.pk, 'sell' if o.is_sell else 'buy',
                 o.amount, o.btc_price,
@@ -695,22 +734,15 @@ class PrivateCommands(commands.Cog, name='Private commands'):
     @command(help='Cancel your order ex. cancelorder 009797b5-571b-4a9b-9608-747a68b9101d', order_index=24)
     @commands.dm_only()
     async def cancelorder(self, ctx: Context, oid: str):
-        sm = ServerMember.from_member(ctx.author)
+        member_id = ServerMember.ensure(ctx.author)
 
         try:
-            o = TradeOrder.objects.get(member=sm, pk=oid, amount__gt=0)
+            o = TradeOrder.objects.get(member_id=member_id, pk=oid, amount__gt=0)
         except (TradeOrder.DoesNotExist, ValidationError):
             return await ctx.send('The order was not found')
-        with transaction.atomic():
-            member = ServerMember.objects.select_for_update().get(pk=o.member_id)
-            if o.is_sell:
-                member.balance += o.amount
-                tx_logger.warning('CANCELORDER,{},+{:.8f}'.format(member, o.amount))
-            else:
-                member.bitcoin_balance += o.amount * o.btc_price
-            member.save()
-        o.delete()
-        await ctx.send('The order was canceled')
+        # the matcher refunds the rest and confirms
+        TradeOrder.objects.filter(pk=o.pk).update(cancel_requested=True)
+        await ctx.send('The order will be canceled shortly')
 
     @command(help='Start a personal masternode (Cold Wallet). You must have min. 3000 SOVE '
                            'on your account and provide correct IP, PORT and Private key from your VPS. '
@@ -734,25 +766,22 @@ class PrivateCommands(commands.Cog, name='Private commands'):
         except Exception:
             return await ctx.send('Address is not reachable')
 
+        masternode_price = await get_masternode_price_async()
+        sm = ServerMember.from_member(ctx.author)
+        total_price = masternode_price + global_preferences['general__transaction_commission']
         with transaction.atomic():
-            sm = ServerMember.from_member(ctx.author)
-            sm = ServerMember.objects.select_for_update().get(pk=sm.pk)
-            masternode_price = get_masternode_price()
-            total_price = masternode_price + global_preferences['general__transaction_commission']
-            if sm.balance < total_price:
+            if not sm.adjust(balance=-total_price):
                 return await ctx.send('Insufficient funds (required {})'.format(fd(total_price)))
-            sm.balance -= total_price
-            sm.save()
-        tx_logger.warning('USERNODE,{},-{:.8f}'.format(sm, total_price))
+            LedgerEntry.post('USERNODE', (sm, 'balance', -total_price))
         UserNode.objects.create(member=sm, address=address, privkey=privkey)
         await ctx.send('Request to start a node was created')
 
     @command(help='List your personal masternodes', order_index=26)
     @commands.dm_only()
     async def mynodes(self, ctx: Context):
-        sm = ServerMember.from_member(ctx.author)
+        member_id = ServerMember.ensure(ctx.author)
         nodes = ['Your nodes:']
-        for un in UserNode.objects.filter(member=sm, active=True):
+        for un in UserNode.objects.filter(member_id=member_id, active=True):
             line = '#{} {}\n[{}]'.format(un.pk, un.address, un.wallet_address)
             if un.pending:
                 line += ' (pending)'
@@ -774,22 +803,22 @@ class PrivateCommands(commands.Cog, name='Private commands'):
         if not un.active:
             return await ctx.send('The node was already stopped')
         if not un.pending:
-            fee = usernode_client.estimate_fee(1)
-            un_price = get_masternode_price()
+            fee = await usernode_client.estimate_fee_async(1)
+            un_price = await get_masternode_price_async()
             inputs = [{'txid': un.output_txid, 'vout': un.output_idx, 'confirmations': 99999999999999,
                        'amount': un_price}]
             outputs = {sm.wallet_address: un_price}
             try:
-                estimate_tx = usernode_client.api.createrawtransaction(inputs, outputs)
-                estimate_tx = usernode_client.api.signrawtransaction(estimate_tx)
+                estimate_tx = await usernode_client.aio.createrawtransaction(inputs, outputs)
+                estimate_tx = await usernode_client.aio.signrawtransaction(estimate_tx)
                 fee *= math.ceil(len(bytes.fromhex(estimate_tx['hex'])) / 1024 + 1)
 
                 outputs[sm.wallet_address] -= fee
                 logging.warning(inputs)
                 logging.warning(outputs)
-                tx = usernode_client.api.createrawtransaction(inputs, outputs)
-                tx = usernode_client.api.signrawtransaction(tx)
-                txid = usernode_client.api.sendrawtransaction(tx['hex'])
+                tx = await usernode_client.aio.createrawtransaction(inputs, outputs)
+                tx = await usernode_client.aio.signrawtransaction(tx)
+                txid = await usernode_client.aio.sendrawtransaction(tx['hex'])
             except:
                 traceback.print_exc()
                 return await ctx.send('Operation is currently unavailable, please try later')
@@ -839,7 +868,7 @@ class PrivateCommands(commands.Cog, name='Private commands'):
                                'You also can use text secret: `{}`'.format(sm.otp_secret),
                                file=File(fpath))
             sm.otp_qr_message_id = m.id
-            sm.save()
+            sm.save(update_fields=('otp_secret', 'otp_qr_message_id'))
 
     @otp.command(order_index=31)
     async def confirm(self, ctx: Context, otp: str):
@@ -853,7 +882,7 @@ class PrivateCommands(commands.Cog, name='Private commands'):
         m = await ctx.fetch_message(sm.otp_qr_message_id)
         await m.delete()
         sm.otp_active = True
-        sm.save()
+        sm.save(update_fields=('otp_active',))
         await ctx.send('2FA was successfully activated.\nCurrent threshold: {} SOVE\n'
                        'Use `2fa threshold <NEW_VALUE> <2fa code>` command to change it.\n\n'
                        'QR code was removed for security purposes.'.format(fd(sm.otp_threshold)))
@@ -881,7 +910,7 @@ class PrivateCommands(commands.Cog, name='Private commands'):
     async def noinform(self, ctx: Context):
         sm = ServerMember.from_member(ctx.author)
         sm.noinform = not sm.noinform
-        sm.save()
+        sm.save(update_fields=('noinform',))
         await ctx.send('Noinform mode was {}'.format('enabled' if sm.noinform else 'disabled'))
 
     @command(help='Track a masternode', order_index=35)
@@ -890,7 +919,7 @@ class PrivateCommands(commands.Cog, name='Private commands'):
         sm = ServerMember.from_member(ctx.author)
 
         try:
-            trackmn(sm, addr)
+            trackmn(sm, addr, await client.aio.masternode('list'))
         except SendMessage as e:
             await ctx.send(e.msg)
     
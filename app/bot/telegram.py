@@ -1,13 +1,14 @@
+import logging
 import os
 import re
 import tempfile
 from datetime import timedelta
 from decimal import Decimal
-from random import randint
 
 import pyotp
 import qrcode
 from django.db import transaction
+from django.db.models import F
 from django.utils.timezone import now
 from dynamic_preferences.registries import global_preferences_registry
 from telegram.error import BadRequest, Unauthorized
@@ -17,9 +18,10 @@ from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from app.bot import get_status, SendMessage, process_unstaking, process_stakingmode, process_mninvest, \
     process_mnwithdraw, process_send, process_sendbtc, process_otp_threshold, \
     process_otp_disable, trackmn, untrackmn, trackmnlist
-from app.models import ServerMember, TGRainTask
+from app.models import ServerMember, TGRainTask, LedgerEntry
+from app.xp import telegram_xp, XP_FLUSH_INTERVAL
 from app.tasks.execute_tgrain import execute_tgrain
-from evosbot.utils import fd, tx_logger
+from evosbot.utils import fd
 
 global_preferences = global_preferences_registry.manager()
 
@@ -223,7 +225,7 @@ def otp_handler(update: Update, ctx: CallbackContext):
                 parse_mode='markdown'
             )
             sm.otp_qr_message_id = m.message_id
-            sm.save()
+            sm.save(update_fields=('otp_secret', 'otp_qr_message_id'))
     elif command == 'confirm':
         try:
             otp, = args
@@ -239,7 +241,7 @@ def otp_handler(update: Update, ctx: CallbackContext):
             return update.effective_message.reply_markdown('Provided one-time password is invalid')
         ctx.bot.delete_message(update.effective_chat.id, sm.otp_qr_message_id)
         sm.otp_active = True
-        sm.save()
+        sm.save(update_fields=('otp_active',))
         return update.effective_message.reply_markdown(
             '2FA was successfully activated.\nCurrent threshold: {} SOVE\n'
             'Use `2fa threshold <NEW_VALUE> <2fa code>` command to change it.\n\n'
@@ -277,7 +279,7 @@ def help_handler(update: Update, ctx: CallbackContext):
 def noinform_handler(update: Update, ctx: CallbackContext):
     sm = ServerMember.from_tg_user(update.effective_user)
     sm.noinform = not sm.noinform
-    sm.save()
+    sm.save(update_fields=('noinform',))
     update.effective_message.reply_text('Noinform mode was {}'.format('enabled' if sm.noinform else 'disabled'))
 
 
@@ -294,6 +296,8 @@ def rain_handler(update: Update, ctx: CallbackContext):
             return update.effective_message.reply_text('Users count should be in interval 1..50')
         if minutes <= 0:
             return update.effective_message.reply_text('Duration should be positive')
+        if amount <= 0:
+            return update.effective_message.reply_text('Amount should be positive')
         if amount > sm.balance:
             return update.effective_message.reply_text('Insufficient funds')
     except:
@@ -306,6 +310,8 @@ def rain_handler(update: Update, ctx: CallbackContext):
         return update.effective_message.reply_text('Bot is not added to the specified chat')
 
     with transaction.atomic():
+        if not sm.adjust(balance=-amount):
+            return update.effective_message.reply_text('Insufficient funds')
         time = now() + timedelta(minutes=minutes)
         t = TGRainTask.objects.create(member=sm, users_cnt=users_cnt, amount=amount, execute_at=time, _chat_id=chat_id)
         markup = InlineKeyboardMarkup([[InlineKeyboardButton('Enter', callback_data='rain_part {}'.format(t.pk))]])
@@ -313,14 +319,12 @@ def rain_handler(update: Update, ctx: CallbackContext):
         m = ctx.bot.send_message(chat_id, msg, 'markdown', reply_markup=markup)
         t.message_id = m.message_id
         t.save()
-        sm.balance -= amount
-        sm.save()
-        tx_logger.warning('TGRAIN_CREATE,{},-{:.8f}'.format(sm, amount))
+        LedgerEntry.post('TGRAIN_CREATE', (sm, 'balance', -amount), reference=t.pk)
         execute_tgrain.apply_async(args=(t.pk,), eta=time)
 
 
 def rain_enter_handler(update: Update, ctx: CallbackContext):
-    sm = ServerMember.from_tg_user(update.effective_user)
+    ServerMember.ensure(update.effective_user)
     _, rain_id = update.callback_query.data.split()
     with transaction.atomic():
         try:
@@ -391,9 +395,10 @@ def like_handler(update: Update, ctx: CallbackContext):
 
     sm.xp += Decimal('.25')
     sm.activity_counter += 1
-    sm.save()
+    ServerMember.objects.filter(pk=sm.pk).update(xp=F('xp') + Decimal('.25'),
+                                                 activity_counter=F('activity_counter') + 1)
     author.last_like = now()
-    author.save()
+    author.save(update_fields=('last_like',))
     message = 'User XP: {sm.xp}\n' \
               'User activity: {sm.activity_counter} minutes\n' \
               'User rank: {sm.rank_display}\n'.format(sm=sm)
@@ -401,12 +406,8 @@ def like_handler(update: Update, ctx: CallbackContext):
 
 
 def message_handler(update: Update, ctx: CallbackContext):
-    sm = ServerMember.from_tg_user(update.effective_user)
-    if len(update.effective_message.text) >= 50 and \
-            (not sm.last_message or now() - sm.last_message > timedelta(seconds=60 + randint(0, 60))):
-        sm.xp += 1
-        sm.last_message = now()
-        sm.save()
+    if len(update.effective_message.text) >= 50:
+        telegram_xp.award(update.effective_user)
 
     if update.effective_message.reply_to_message:
         text = re.sub(r'\W', '', update.effective_message.text).lower()
@@ -414,6 +415,13 @@ def message_handler(update: Update, ctx: CallbackContext):
             like_handler(update, ctx)
 
 
+def xp_flush_job(ctx: CallbackContext):
+    try:
+        telegram_xp.flush()
+    except Exception:
+        logging.exception('Could not flush xp')
+
+
 def get_updater():
     updater = Updater(global_preferences['general__telegram_bot_token'], use_context=True)
     updater.dispatcher.add_handler(CommandHandler('start', status_handler, Filters.private))
@@ -438,6 +446,7 @@ def get_updater():
     updater.dispatcher.add_handler(CallbackQueryHandler(rain_enter_handler, pattern=r'^rain_part \d+$'))
     updater.dispatcher.add_handler(CommandHandler('like', like_handler, Filters.group & Filters.reply))
     updater.dispatcher.add_handler(MessageHandler(Filters.text, message_handler))
+    updater.job_queue.run_repeating(xp_flush_job, XP_FLUSH_INTERVAL)
 
     return updater
 
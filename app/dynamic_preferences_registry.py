@@ -189,6 +189,14 @@ class TelegramAirdropMultiplier(DecimalPreference):
     name = 'telegram_airdrop_multiplier'
 
 
+@global_preferences_registry.register
+class MasternodeLogRetention(IntegerPreference):
+    section = general
+    default = 0
+    name = 'masternode_log_retention'
+    help_text = 'Days to keep raw masternode balance log rows, 0 to keep forever'
+
+
 # internal
 
 
@@ -206,6 +214,49 @@ class LastMasternodeBlock(StringPreference):
     name = 'last_masternode_block'
 
 
+@global_preferences_registry.register
+class LastDepositBlock(StringPreference):
+    section = internal
+    default = ''
+    name = 'last_deposit_block'
+
+
+@global_preferences_registry.register
+class LastBitcoinDepositBlock(StringPreference):
+    section = internal
+    default = ''
+    name = 'last_bitcoin_deposit_block'
+
+
+@global_preferences_registry.register
+class MasternodeDust(DecimalPreference):
+    section = internal
+    field_kwargs = {
+        'max_digits': 32,
+        'decimal_places': 18,
+    }
+    default = Decimal(0)
+    name = 'masternode_dust'
+
+
+@global_preferences_registry.register
+class StakingPoolDust(DecimalPreference):
+    section = internal
+    field_kwargs = {
+        'max_digits': 32,
+        'decimal_places': 18,
+    }
+    default = Decimal(0)
+    name = 'staking_pool_dust'
+
+
+@global_preferences_registry.register
+class CandleCursor(IntegerPreference):
+    section = internal
+    default = 0
+    name = 'candle_cursor'
+
+
 @global_preferences_registry.register
 class StakingPoolAddress(StringPreference):
     section = internal
@@ -0,0 +1,237 @@
+import logging
+from bisect import bisect_left, insort
+from collections import deque, namedtuple
+
+from django.core.cache import cache
+from django.db import transaction, connection
+from django.db.models import Q, Sum, F
+
+from app.models import TradeOrder, OrderLog, ServerMember, LedgerEntry, Notification
+
+BATCH_SIZE = 500
+DEPTH_KEY = 'exchange:depth'
+DEPTH_LEVELS = 10
+# postgres advisory lock held by the running matcher for the lifetime of its connection
+MATCHER_LOCK_ID = 0x6d61746368
+
+Fill = namedtuple('Fill', 'taker maker amount price')
+
+
+class Order:
+    __slots__ = 'id', 'member_id', 'is_sell', 'amount', 'price'
+
+    def __init__(self, id, member_id, is_sell, amount, price):
+        self.id = id
+        self.member_id = member_id
+        self.is_sell = is_sell
+        self.amount = amount
+        self.price = price
+
+
+class OrderBook:
+    # price-time priority: sorted price levels per side, FIFO queue per level, fills at the resting price
+    def __init__(self):
+        self.levels = {True: {}, False: {}}
+        self.prices = {True: [], False: []}
+        self.orders = {}
+        # amount per price level and btc value per side, kept up to date for depth snapshots
+        self.depth = {True: {}, False: {}}
+        self.totals = {True: 0, False: 0}
+
+    def adjust(self, is_sell, price, amount):
+        self.depth[is_sell][price] = self.depth[is_sell].get(price, 0) + amount
+        self.totals[is_sell] += amount * price
+
+    def best(self, is_sell):
+        prices = self.prices[is_sell]
+        if not prices:
+            return None
+        return prices[0] if is_sell else prices[-1]
+
+    def crosses(self, order):
+        best = self.best(not order.is_sell)
+        if best is None:
+            return False
+        return best >= order.price if order.is_sell else best <= order.price
+
+    def rest(self, order):
+        levels = self.levels[order.is_sell]
+        if order.price not in levels:
+            levels[order.price] = deque()
+            insort(self.prices[order.is_sell], order.price)
+        levels[order.price].append(order)
+        self.orders[order.id] = order
+        self.adjust(order.is_sell, order.price, order.amount)
+
+    def remove_level(self, is_sell, price):
+        del self.levels[is_sell][price]
+        del self.depth[is_sell][price]
+        prices = self.prices[is_sell]
+        del prices[bisect_left(prices, price)]
+
+    def add(self, order):
+        # matches the order against the book, the remainder rests; returns the fills
+        fills = []
+        side = not order.is_sell
+        while order.amount > 0 and self.crosses(order):
+            price = self.best(side)
+            level = self.levels[side][price]
+            maker = level[0]
+            amount = min(maker.amount, order.amount)
+            maker.amount -= amount
+            order.amount -= amount
+            self.adjust(side, price, -amount)
+            fills.append(Fill(order, maker, amount, price))
+            if not maker.amount:
+                level.popleft()
+                del self.orders[maker.id]
+                if not level:
+                    self.remove_level(side, price)
+        if order.amount > 0:
+            self.rest(order)
+        return fills
+
+    def cancel(self, order_id):
+        # returns the removed order or None when it is not in the book
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        level = self.levels[order.is_sell][order.price]
+        level.remove(order)
+        self.adjust(order.is_sell, order.price, -order.amount)
+        if not level:
+            self.remove_level(order.is_sell, order.price)
+        return order
+
+    def snapshot(self, levels=DEPTH_LEVELS):
+        sell = [(price, self.depth[True][price]) for price in self.prices[True][:levels]]
+        buy = [(price, self.depth[False][price]) for price in reversed(self.prices[False][-levels:])]
+        return {'sell': sell, 'buy': buy, 'sell_total': self.totals[True], 'buy_total': self.totals[False]}
+
+
+def get_depth():
+    # the matcher publishes the snapshot after every batch, the database is only a fallback
+    depth = cache.get(DEPTH_KEY)
+    if depth is not None:
+        return depth
+    depth = {}
+    for is_sell, side, order in ((True, 'sell', 'btc_price'), (False, 'buy', '-btc_price')):
+        qs = TradeOrder.objects.filter(is_sell=is_sell, amount__gt=0, pending=False)
+        depth[side] = list(qs.values_list('btc_price').annotate(amount=Sum('amount')).order_by(order)[:DEPTH_LEVELS])
+        depth[side + '_total'] = qs.aggregate(sum=Sum(F('amount') * F('btc_price')))['sum'] or 0
+    return depth
+
+
+def try_matcher_lock():
+    # returns whether this connection holds the lock, taking it if it is free; re-entrant within the session
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [MATCHER_LOCK_ID])
+        return cursor.fetchone()[0]
+
+
+class Matcher:
+    # the single writer of TradeOrder amounts: orders are matched in memory, every batch is persisted in one transaction
+    def __init__(self):
+        self.book = OrderBook()
+
+    def load(self):
+        self.book = OrderBook()
+        orders = TradeOrder.objects.filter(pending=False, amount__gt=0).order_by('created_at') \
+            .values_list('pk', 'member_id', 'is_sell', 'amount', 'btc_price')
+        for row in orders.iterator():
+            self.book.rest(Order(*row))
+        self.publish()
+
+    def publish(self):
+        cache.set(DEPTH_KEY, self.book.snapshot(), None)
+
+    def process_batch(self):
+        pending = list(TradeOrder.objects.filter(pending=True).order_by('created_at')
+                       .values_list('pk', 'member_id', 'is_sell', 'amount', 'btc_price')[:BATCH_SIZE])
+        accepted = [Order(*row) for row in pending]
+        cancels = list(TradeOrder.objects.filter(Q(pending=False) | Q(pk__in=[o.id for o in accepted]),
+                                                 cancel_requested=True)
+                       .values_list('pk', 'member_id')[:BATCH_SIZE])
+        if not accepted and not cancels:
+            return 0
+
+        fills = []
+        touched = {}
+        for order in accepted:
+            touched[order.id] = order
+            for fill in self.book.add(order):
+                fills.append(fill)
+                touched[fill.maker.id] = fill.maker
+        canceled = [(pk, member_id, self.book.cancel(pk)) for pk, member_id in cancels]
+
+        try:
+            self.persist(accepted, fills, touched, canceled)
+        except Exception:
+            # the book is ahead of the database now, rebuild it
+            self.load()
+            raise
+        self.publish()
+        return len(accepted) + len(canceled)
+
+    def persist(self, accepted, fills, touched, canceled):
+        with transaction.atomic():
+            member_ids = {o.member_id for o in touched.values()} | {member_id for _, member_id, _ in canceled}
+            members = ServerMember.objects.select_for_update().in_bulk(member_ids - {None})
+            entries = []
+            logs = []
+            notifications = []
+
+            for taker, maker, amount, price in fills:
+                buyer, seller = (maker, taker) if taker.is_sell else (taker, maker)
+                total = amount * price
+                refund = (buyer.price - price) * amount
+                logs.append(OrderLog(amount=amount, btc_price=price, is_sell=taker.is_sell))
+                buyer_member, seller_member = members.get(buyer.member_id), members.get(seller.member_id)
+                if buyer_member:
+                    buyer_member.balance += amount
+                    buyer_member.bitcoin_balance += refund
+                    notifications.append(Notification(
+                        member=buyer_member, content='Bought {:.8f} for {:.8f} BTC'.format(amount, total)))
+                if seller_member:
+                    seller_member.bitcoin_balance += total
+                    notifications.append(Notification(
+                        member=seller_member, content='Sold {:.8f} for {:.8f} BTC'.format(amount, total)))
+                legs = (buyer_member, 'balance', amount), (buyer_member, 'bitcoin_balance', refund), \
+                       (seller_member, 'bitcoin_balance', total)
+                entries += LedgerEntry.build('BUY', *[leg for leg in legs if leg[0]], reference=taker.id)
+
+            deleted = []
+            for pk, member_id, order in canceled:
+                member = members.get(member_id)
+                if order is None:
+                    if member:
+                        notifications.append(Notification(
+                            member=member, content='Order #{} could not be canceled, it was executed'.format(pk)))
+                    continue
+                touched.pop(pk, None)
+                deleted.append(pk)
+                if not member:
+                    continue
+                if order.is_sell:
+                    member.balance += order.amount
+                    leg = member, 'balance', order.amount
+                else:
+                    member.bitcoin_balance += order.amount * order.price
+                    leg = member, 'bitcoin_balance', order.amount * order.price
+                entries += LedgerEntry.build('CANCELORDER', leg, reference=pk)
+                notifications.append(Notification(member=member, content='Order #{} was canceled'.format(pk)))
+
+            # amounts of the orders are written by the matcher only
+            TradeOrder.objects.bulk_update(
+                [TradeOrder(pk=o.id, amount=o.amount, pending=False) for o in touched.values()],
+                ('amount', 'pending'), batch_size=BATCH_SIZE
+            )
+            TradeOrder.objects.filter(pk__in=[pk for pk, _, order in canceled if order is None]) \
+                .update(cancel_requested=False)
+            TradeOrder.objects.filter(pk__in=deleted).delete()
+            ServerMember.objects.bulk_update(members.values(), ('balance', 'bitcoin_balance'), batch_size=BATCH_SIZE)
+            OrderLog.objects.bulk_create(logs, batch_size=BATCH_SIZE)
+            entries = LedgerEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+            Notification.objects.bulk_create(notifications, batch_size=BATCH_SIZE)
+        LedgerEntry.log(entries)
+        logging.warning('Matched {} orders: {} fills, {} canceled'.format(len(accepted), len(fills), len(deleted)))
@@ -0,0 +1,82 @@
+import random
+from decimal import Decimal
+from time import perf_counter
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from app.exchange import OrderBook, Order, Matcher, BATCH_SIZE, DEPTH_KEY
+from app.models import ServerMember, TradeOrder
+from evosbot.utils import tx_logger
+
+BENCHMARK_PK_BASE = 10**17
+
+
+class Rollback(Exception):
+    pass
+
+
+def generate_orders(rnd, count, members):
+    # prices around 20000 satoshis, so roughly half of the orders cross the book
+    for _ in range(count):
+        yield Order(uuid4(), BENCHMARK_PK_BASE + rnd.randrange(members), rnd.random() < 0.5,
+                    Decimal(rnd.randint(1, 10000)) / 100, Decimal(rnd.randint(19000, 21000)) / 10**8)
+
+
+class Command(BaseCommand):
+    help = 'Measure order matching throughput in memory and, with --persist, including the database writes; ' \
+           'all changes are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=100000)
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--persist', action='store_true')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        count = options['orders']
+        orders = list(generate_orders(rnd, count, options['members']))
+
+        book = OrderBook()
+        fills = 0
+        start = perf_counter()
+        for o in orders:
+            fills += len(book.add(Order(o.id, o.member_id, o.is_sell, o.amount, o.price)))
+        elapsed = perf_counter() - start
+        print('In memory: {} orders, {} fills in {:.2f}s ({:.0f} orders/s)'.format(
+            count, fills, elapsed, count / elapsed))
+
+        if options['persist']:
+            self.persist(orders, options['members'])
+
+    def persist(self, orders, members):
+        # benchmark members do not belong in the transaction log
+        tx_logger.disabled = True
+        try:
+            with transaction.atomic():
+                ServerMember.objects.bulk_create([
+                    ServerMember(id=BENCHMARK_PK_BASE + i, name='benchmark {}'.format(i)) for i in range(members)
+                ], batch_size=5000)
+                TradeOrder.objects.bulk_create([
+                    TradeOrder(id=o.id, member_id=o.member_id, is_sell=o.is_sell, amount=o.amount, btc_price=o.price)
+                    for o in orders
+                ], batch_size=5000)
+
+                matcher = Matcher()
+                start = perf_counter()
+                processed = 0
+                while processed < len(orders):
+                    processed += matcher.process_batch()
+                elapsed = perf_counter() - start
+                print('Persisted: {} orders in batches of {} in {:.2f}s ({:.0f} orders/s)'.format(
+                    processed, BATCH_SIZE, elapsed, processed / elapsed))
+                raise Rollback
+        except Rollback:
+            print('Rolled back')
+        finally:
+            tx_logger.disabled = False
+            # drop the benchmark depth, $orders falls back to the database until the matcher publishes again
+            cache.delete(DEPTH_KEY)
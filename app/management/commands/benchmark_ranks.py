@@ -0,0 +1,61 @@
+import random
+from datetime import timedelta
+from time import perf_counter
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+
+from app.models import ServerMember
+from app.tasks.update_ranks import apply_rank_changes
+
+BENCHMARK_PK_BASE = 10**17
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time one rank engine pass over generated members; all changes are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        count = options['members']
+        ts = now()
+        try:
+            with transaction.atomic():
+                start = perf_counter()
+                ids = [(BENCHMARK_PK_BASE + i) * (1 if i % 4 else -1) for i in range(count)]
+                ServerMember.objects.bulk_create([
+                    ServerMember(
+                        id=pk,
+                        name='benchmark {}'.format(pk),
+                        rank=rnd.randint(ServerMember.Rank.BRAND_NEW, ServerMember.Rank.GURU),
+                        xp=rnd.randint(0, 5000),
+                        activity_counter=rnd.randint(0, 60*24*20),
+                    ) for pk in ids
+                ], batch_size=5000)
+                # auto_now_add overrides dates on insert, backdate them in buckets
+                buckets = {}
+                for pk in ids:
+                    buckets.setdefault((rnd.randint(0, 3) * 4, rnd.randint(0, 1) * 40), []).append(pk)
+                for (rank_days, activity_days), pks in buckets.items():
+                    ServerMember.objects.filter(pk__in=pks).update(
+                        last_rank_change=ts - timedelta(rank_days),
+                        last_forced_activity_update=ts - timedelta(activity_days),
+                    )
+                print('Seeded {} members in {:.2f}s'.format(count, perf_counter() - start))
+
+                start = perf_counter()
+                _, changes = apply_rank_changes()
+                elapsed = perf_counter() - start
+                promotes = sum(1 for _, is_promote in changes if is_promote)
+                print('Rank pass: {:.2f}s, {} promoted, {} demoted'.format(elapsed, promotes, len(changes) - promotes))
+                raise Rollback
+        except Rollback:
+            print('Rolled back')
@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from evosbot.utils import chain_caches
+
+
+class Command(BaseCommand):
+    help = 'Show the hit rate of the decoded transaction and block caches over all processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Start counting from zero')
+
+    def handle(self, *args, **options):
+        for namespace, chain_cache in chain_caches.items():
+            info = chain_cache.shared_info()
+            print('{}: hit rate {:.1%} (local hits: {}, shared hits: {}, misses: {})'.format(
+                namespace, info['hit_rate'], info['local_hits'], info['shared_hits'], info['misses']))
+            if options['reset']:
+                chain_cache.reset_stats()
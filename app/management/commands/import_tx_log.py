@@ -0,0 +1,81 @@
+import re
+from datetime import datetime
+from decimal import Decimal
+from uuid import uuid5, NAMESPACE_URL
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import make_aware, is_naive
+
+from app.models import ServerMember, LedgerEntry
+
+# {asctime},{kind},{member name} (#{id}),{delta}[,{reference}]
+LINE_RE = re.compile(r'^(?P<asctime>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}),(?P<kind>[A-Z0-9_]+),'
+                     r'(?P<name>.*) \(#(?P<pk>-?\d+)\),(?P<delta>[+-]?\d+\.\d+)(?:,(?P<reference>.*))?$')
+
+
+class Command(BaseCommand):
+    help = 'Import balance changes from the tx.log CSV into the ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--until', help='Skip lines at or after this time, by default the first entry the ledger '
+                                            'posted itself; later lines are already in the ledger')
+
+    @staticmethod
+    def live_since():
+        # member legs posted by the ledger carry balance_after, imported ones do not
+        return LedgerEntry.objects.filter(member__isnull=False, balance_after__isnull=False) \
+            .aggregate(since=Min('datetime'))['since']
+
+    def import_batch(self, rows):
+        # rows: (entry id, line fields, time); entries that are already imported are skipped
+        existing = set(LedgerEntry.objects.filter(entry__in=[entry for entry, _, _ in rows])
+                       .values_list('entry', flat=True))
+        rows = [row for row in rows if row[0] not in existing]
+        known = set(ServerMember.objects.filter(pk__in={int(m['pk']) for _, m, _ in rows}).values_list('pk', flat=True))
+        entries = []
+        for entry, m, ts in rows:
+            pk, delta = int(m['pk']), Decimal(m['delta'])
+            reference = m['reference'] or (None if pk in known else 'member #{}'.format(pk))
+            entries.append(LedgerEntry(entry=entry, member_id=pk if pk in known else None, account='balance',
+                                       kind=m['kind'], delta=delta, reference=reference, datetime=ts))
+            entries.append(LedgerEntry(entry=entry, account=LedgerEntry.SYSTEM_ACCOUNTS.get(m['kind'], 'wallet'),
+                                       kind=m['kind'], delta=-delta, reference=reference, datetime=ts))
+        with transaction.atomic():
+            LedgerEntry.objects.bulk_create(entries)
+        return len(rows)
+
+    def handle(self, *args, **options):
+        until = parse_datetime(options['until']) if options['until'] else self.live_since()
+        if until and is_naive(until):
+            until = make_aware(until)
+        imported = skipped = late = 0
+        rows = []
+        seen, seen_ts = {}, None
+        with open(options['path'], encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                m = LINE_RE.match(line)
+                if not m:
+                    skipped += 1
+                    continue
+                ts = make_aware(datetime.strptime(m['asctime'], '%Y-%m-%d %H:%M:%S,%f'))
+                if until and ts >= until:
+                    late += 1
+                    continue
+                # the entry id is derived from the line and its occurrence, so importing the file again adds nothing;
+                # identical lines share the timestamp, so occurrences are only counted within one
+                if ts != seen_ts:
+                    seen, seen_ts = {}, ts
+                seen[line] = seen.get(line, 0) + 1
+                rows.append((uuid5(NAMESPACE_URL, 'tx.log:{}#{}'.format(line, seen[line])), m.groupdict(), ts))
+                if len(rows) >= options['batch_size']:
+                    imported += self.import_batch(rows)
+                    rows = []
+        if rows:
+            imported += self.import_batch(rows)
+        print('Imported {} lines, skipped {} unparsable and {} at or after {}'.format(imported, skipped, late, until))
@@ -0,0 +1,122 @@
+import logging
+from datetime import timedelta
+from time import sleep, monotonic
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+from telegram.error import RetryAfter, Unauthorized, BadRequest
+
+from app.models import Notification
+from evosbot.utils import send_discord_message, DiscordAPI
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 3600
+# seconds between messages of one bucket
+BUCKET_INTERVALS = {
+    'channel': 1,
+    'dm': 1,
+    'tg': 1,
+}
+TELEGRAM_INTERVAL = 1 / 30
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+class Undeliverable(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = {}
+        self.tg_bot = None
+        self.tg_next = 0
+
+    def wait_for(self, key, seconds):
+        self.buckets[key] = max(self.buckets.get(key, 0), monotonic() + seconds)
+
+    def deliver(self, n: Notification, content):
+        if n.channel or n.member_id > 0:
+            r = send_discord_message(n.channel or n.member.dm_channel, content)
+            if r.status_code == 429:
+                raise RateLimited(DiscordAPI.retry_after(r))
+            if r.status_code == 403:
+                raise Undeliverable(r.text)
+            r.raise_for_status()
+        else:
+            if self.tg_bot is None:
+                from app.bot.telegram import get_bot
+                self.tg_bot = get_bot()
+            sleep(max(self.tg_next - monotonic(), 0))
+            self.tg_next = monotonic() + TELEGRAM_INTERVAL
+            try:
+                self.tg_bot.send_message(n.member_id + 10**10, content)
+            except RetryAfter as e:
+                raise RateLimited(e.retry_after)
+            except (Unauthorized, BadRequest) as e:
+                raise Undeliverable(str(e))
+
+    def pending(self):
+        ts = monotonic()
+        blocked = [bucket for bucket, until in self.buckets.items() if until > ts]
+        qs = Notification.objects.filter(sent=False, send_after__lte=now())
+        channels = [key for kind, key in blocked if kind == 'channel']
+        if channels:
+            qs = qs.exclude(channel__in=channels)
+        members = [key for kind, key in blocked if kind != 'channel']
+        if members:
+            qs = qs.exclude(member_id__in=members, channel__isnull=True)
+        return qs.select_related('member').order_by('id').select_for_update(skip_locked=True, of=('self',))
+
+    def process_batch(self):
+        processed = 0
+        with transaction.atomic():
+            buckets = {}
+            for n in self.pending()[:BATCH_SIZE]:  # type: Notification
+                buckets.setdefault(n.bucket, []).append(n)
+
+            for bucket, notifications in buckets.items():
+                # one request per bucket and round, channel posts are merged up to the message limit
+                group = notifications[:1]
+                if bucket[0] == 'channel':
+                    for n in notifications[1:]:
+                        if sum(len(g.content) + 1 for g in group) + len(n.content) > DISCORD_MESSAGE_LIMIT:
+                            break
+                        group.append(n)
+                content = '\n'.join(n.content for n in group)
+                processed += len(group)
+                try:
+                    self.deliver(group[0], content)
+                    error, sent = None, True
+                    self.wait_for(bucket, BUCKET_INTERVALS[bucket[0]])
+                except RateLimited as e:
+                    logging.warning('Rate limited on {}, retry after {}s'.format(bucket, e.retry_after))
+                    self.wait_for(bucket, e.retry_after)
+                    continue
+                except Undeliverable as e:
+                    logging.warning('Notification #{} is undeliverable: {}'.format(group[0].pk, e))
+                    error, sent = str(e), True
+                except Exception as e:
+                    logging.exception('Could not send notification #{}'.format(group[0].pk))
+                    error, sent = str(e), False
+                for n in group:
+                    n.last_error = error
+                    n.sent = sent
+                    if not sent:
+                        n.attempts += 1
+                        n.send_after = now() + timedelta(seconds=min(2 ** n.attempts, MAX_BACKOFF))
+                        n.sent = n.attempts >= MAX_ATTEMPTS
+                Notification.objects.bulk_update(group, ('sent', 'attempts', 'last_error', 'send_after'))
+        return processed
+
+    def handle(self, *args, **options):
+        while True:
+            if not self.process_batch():
+                sleep(1)
@@ -0,0 +1,26 @@
+import logging
+from time import sleep
+
+from django.core.management import BaseCommand, CommandError
+
+from app.exchange import Matcher, try_matcher_lock
+
+
+class Command(BaseCommand):
+    help = 'Match trade orders; a second instance exits while one is running'
+
+    def handle(self, *args, **options):
+        if not try_matcher_lock():
+            raise CommandError('Another order matcher is running')
+        matcher = Matcher()
+        matcher.load()
+        while True:
+            try:
+                if not matcher.process_batch():
+                    sleep(0.5)
+            except Exception:
+                logging.exception('Could not process orders')
+                sleep(5)
+                # the lock goes with the connection, a reconnected session has to take it again
+                if not try_matcher_lock():
+                    raise CommandError('Lost the order matcher lock to another instance')
@@ -1,49 +1,88 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 from django.core.management import BaseCommand
 from dynamic_preferences.registries import global_preferences_registry
 
 from app.models import UpdateRoleTask
-from evosbot.utils import get_member, set_roles
+from evosbot.utils import get_member, set_roles, get_role_snapshots, set_role_snapshots
 
 global_preferences = global_preferences_registry.manager()
 
+BATCH_SIZE = 1000
+WORKERS = 8
+
+
+def split_roles(roles):
+    return set(roles.split('|')) - {''} if roles else set()
+
+
+def coalesce(tasks):
+    # {member id: {role id: should be present}}, later tasks win
+    diffs = {}
+    for task in tasks:
+        diff = diffs.setdefault(task['member_id'], {})
+        for role in split_roles(task['remove_roles']):
+            diff[role] = False
+        for role in split_roles(task['add_roles']):
+            diff[role] = True
+    return diffs
+
+
+def apply_diff(roles, diff):
+    return {r for r in roles if diff.get(r, True)} | {r for r, present in diff.items() if present}
+
 
 class Command(BaseCommand):
+    def update_member(self, guild_id, member_id, diff, snapshot):
+        # returns True when the member's tasks are done
+        if snapshot is not None and apply_diff(snapshot, diff) == snapshot:
+            return True
+        m = get_member(guild_id, member_id)
+        if 'roles' not in m:
+            if m.get('code') == 10007:  # unknown member
+                logging.warning('Unknown member #{}, possibly banned'.format(member_id))
+                return True
+            logging.error('Received member object does not have `roles` field: {}'.format(m))
+            return False
+        current_roles = set(m['roles'])
+        new_roles = apply_diff(current_roles, diff)
+        if new_roles != current_roles:
+            r = set_roles(guild_id, member_id, list(new_roles))
+            if r.status_code != 204:
+                logging.error('Could not update roles of #{}: {}'.format(member_id, r.text))
+                return not (r.status_code == 429 or r.status_code >= 500)
+            logging.warning('Roles of #{} updated successfully'.format(member_id))
+        set_role_snapshots({member_id: new_roles})
+        return True
+
+    def process_batch(self, executor):
+        tasks = list(UpdateRoleTask.objects.filter(processed=False).order_by('id')
+                     .values('id', 'member_id', 'remove_roles', 'add_roles')[:BATCH_SIZE])
+        if not tasks:
+            return 0
+        guild_id = global_preferences['general__guild_id']
+        diffs = coalesce(tasks)
+        snapshots = get_role_snapshots(list(diffs))
+        futures = {
+            member_id: executor.submit(self.update_member, guild_id, member_id, diff, snapshots.get(member_id))
+            for member_id, diff in diffs.items()
+        }
+        done = set()
+        for member_id, future in futures.items():
+            try:
+                if future.result():
+                    done.add(member_id)
+            except Exception:
+                logging.exception('Could not update roles of #{}'.format(member_id))
+        UpdateRoleTask.objects.filter(pk__in=[t['id'] for t in tasks if t['member_id'] in done]).update(processed=True)
+        logging.warning('Processed {} tasks for {} members, {} postponed'.format(
+            len(tasks), len(diffs), len(diffs) - len(done)))
+        return len(done)
+
     def handle(self, *args, **options):
-        while True:
-            for task in UpdateRoleTask.objects.filter(processed=False).order_by('id'):  # type: UpdateRoleTask
-                logging.warning('Processing task #{} (member #{})'.format(task.pk, task.member.pk))
-                m = get_member(global_preferences['general__guild_id'], task.member.pk)
-                if 'roles' not in m:
-                    logging.error('Received member object does not have `roles` field: {}'.format(m))
-                    if 'code' in m and m['code'] == 10007:  # unknown member
-                        logging.warning('Unknown member, possibly banned')
-                    else:
-                        break
-                else:
-                    changed = False
-                    current_roles = set(m['roles'])
-                    if task.remove_roles:
-                        remove_roles = set(task.remove_roles.split('|'))
-                        if remove_roles.intersection(current_roles):
-                            changed = True
-                            current_roles -= remove_roles
-                    if task.add_roles:
-                        add_roles = set(task.add_roles.split('|'))
-                        if not add_roles.issubset(current_roles):
-                            changed = True
-                            current_roles.update(add_roles)
-                    if changed:
-                        r = set_roles(global_preferences['general__guild_id'], task.member.pk, list(current_roles))
-                        if r.status_code != 204:
-                            logging.error('Could not update roles: {}'.format(r.json()))
-                            break
-                        logging.warning('Roles updated successfully')
-                    else:
-                        logging.warning('Nothing to update')
-                task.processed = True
-                task.save()
-                sleep(.2)
-            sleep(5)
+        with ThreadPoolExecutor(WORKERS) as executor:
+            while True:
+                if not self.process_batch(executor):
+                    sleep(5)
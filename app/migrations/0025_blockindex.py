@@ -0,0 +1,23 @@
+# Generated by Django 2.2.2 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_servermember_username'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockIndex',
+            fields=[
+                ('height', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('pos_reward', models.DecimalField(blank=True, decimal_places=8, max_digits=32, null=True)),
+                ('mn_reward', models.DecimalField(blank=True, decimal_places=8, max_digits=32, null=True)),
+            ],
+        ),
+    ]
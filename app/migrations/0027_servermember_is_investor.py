@@ -0,0 +1,18 @@
+# Generated by Django 2.2.2 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servermember',
+            name='is_investor',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.2 on 2026-10-18 14:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_servermember_is_investor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('entry', models.UUIDField(db_index=True, default=uuid.uuid4)),
+                ('account', models.CharField(max_length=32)),
+                ('kind', models.CharField(max_length=32)),
+                ('delta', models.DecimalField(decimal_places=8, max_digits=32)),
+                ('balance_after', models.DecimalField(blank=True, decimal_places=8, max_digits=32, null=True)),
+                ('reference', models.CharField(blank=True, max_length=128, null=True)),
+                ('datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('member', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='app.ServerMember')),
+            ],
+            options={
+                'index_together': {('member', 'datetime'), ('kind', 'datetime')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.2 on 2026-10-18 15:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0028_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='masternodebalancelog',
+            name='datetime',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='masternodebalancelog',
+            index_together={('member', 'datetime')},
+        ),
+        migrations.CreateModel(
+            name='MasternodeBalanceDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('delta_sum', models.DecimalField(decimal_places=8, default=0, max_digits=32)),
+                ('balance', models.DecimalField(decimal_places=8, default=0, max_digits=32)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='masternode_balance_days', to='app.ServerMember')),
+            ],
+            options={
+                'unique_together': {('member', 'day')},
+            },
+        ),
+    ]
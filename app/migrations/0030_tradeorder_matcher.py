@@ -0,0 +1,35 @@
+# Generated by Django 2.2.2 on 2026-10-18 15:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0029_masternodebalancedaily'),
+    ]
+
+    operations = [
+        # existing orders are already matched
+        migrations.AddField(
+            model_name='tradeorder',
+            name='pending',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='tradeorder',
+            name='pending',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+        migrations.AddField(
+            model_name='tradeorder',
+            name='cancel_requested',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='tradeorder',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
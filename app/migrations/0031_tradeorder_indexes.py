@@ -0,0 +1,22 @@
+# Generated by Django 2.2.2 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0030_tradeorder_matcher'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tradeorder',
+            name='pending',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='tradeorder',
+            index_together={('pending', 'created_at'), ('is_sell', 'amount', 'btc_price')},
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0031_tradeorder_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.PositiveIntegerField(choices=[(60, '1m'), (3600, '1h'), (86400, '1d')])),
+                ('start', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=8, max_digits=32)),
+                ('high', models.DecimalField(decimal_places=8, max_digits=32)),
+                ('low', models.DecimalField(decimal_places=8, max_digits=32)),
+                ('close', models.DecimalField(decimal_places=8, max_digits=32)),
+                ('volume', models.DecimalField(decimal_places=8, default=0, max_digits=32)),
+                ('btc_volume', models.DecimalField(decimal_places=8, default=0, max_digits=32)),
+                ('trades', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('interval', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.2 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+def mark_rolled_up(apps, schema_editor):
+    # rows up to the former pk cursor are already in MasternodeBalanceDaily
+    preferences = apps.get_model('dynamic_preferences', 'GlobalPreferenceModel').objects \
+        .filter(section='internal', name='masternode_rollup_cursor')
+    cursor = preferences.first()
+    if cursor is not None and cursor.raw_value:
+        apps.get_model('app', 'MasternodeBalanceLog').objects \
+            .filter(pk__lte=int(cursor.raw_value)).update(rolled_up=True)
+    preferences.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0032_candle'),
+        ('dynamic_preferences', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masternodebalancelog',
+            name='rolled_up',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_rolled_up, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,27 @@
+from datetime import datetime, timedelta
 from decimal import Decimal
 from uuid import uuid4
 
 from computedfields.models import computed, ComputedFieldsModel
 from discord import Member
-from django.db import models, transaction
+from django.core.cache import cache
+from django.db import models, connection
 from django.db.models import Sum
-from django.utils.timezone import now
+from django.utils.timezone import now, utc
 from dynamic_preferences.registries import global_preferences_registry
 from telegram import User
 from telegram.utils.helpers import mention_markdown
 
-from evosbot.utils import client, staking_client, get_api_session, send_discord_message, bitcoin_client, tx_logger, fd
+from evosbot.utils import client, staking_client, create_dm_channel, send_discord_message, bitcoin_client, tx_logger, fd
 
 global_preferences = global_preferences_registry.manager()
 
+IDENTITY_TTL = 60*60
+
+
+def _identity_key(pk):
+    return 'identity:{}'.format(pk)
+
 
 class ServerMember(ComputedFieldsModel):
     class Rank:
@@ -75,6 +83,10 @@ class ServerMember(ComputedFieldsModel):
     otp_threshold = models.DecimalField(max_digits=32, decimal_places=8, default=1)
     otp_qr_message_id = models.BigIntegerField(null=True, blank=True)
 
+    is_investor = models.BooleanField(null=True, blank=True)
+
+    BALANCE_FIELDS = 'balance', 'bitcoin_balance', 'masternode_balance', 'staking_pool_amount'
+
     def __str__(self):
         return '{} (#{})'.format(self.name, self.id)
 
@@ -83,18 +95,37 @@ class ServerMember(ComputedFieldsModel):
         return self.referrals.filter(rank__gt=ServerMember.Rank.BRAND_NEW).count()
 
     @staticmethod
-    def from_member_with_created(member: Member, **kwargs):
-        sm, created = ServerMember.objects.get_or_create(id=member.id, defaults={
-            'name': member.display_name,
-            'avatar': member.avatar_url,
-            **kwargs
-        })
+    def identity(member):
+        # (pk, profile fields) of a discord member or a telegram user
+        if isinstance(member, User):
+            return -10**10 + member.id, {'name': member.full_name, 'username': member.username}
+        return member.id, {'name': member.display_name, 'avatar': str(member.avatar_url)}
+
+    @staticmethod
+    def update_identity(sm: 'ServerMember', profile, created):
+        # saves only the profile fields that changed
         if not created:
-            if member.display_name != sm.name:
-                sm.name = member.display_name
-            if member.avatar_url != sm.avatar:
-                sm.avatar = member.avatar_url
-            sm.save()
+            changed = [field for field, value in profile.items() if getattr(sm, field) != value]
+            for field in changed:
+                setattr(sm, field, profile[field])
+            if changed:
+                sm.save(update_fields=changed)
+
+    @staticmethod
+    def ensure(member):
+        # pk of the member, touches the database only when the profile is not known to be up to date
+        pk, profile = ServerMember.identity(member)
+        if cache.get(_identity_key(pk)) != profile:
+            sm, created = ServerMember.objects.get_or_create(id=pk, defaults=profile)
+            ServerMember.update_identity(sm, profile, created)
+            cache.set(_identity_key(pk), profile, IDENTITY_TTL)
+        return pk
+
+    @staticmethod
+    def from_member_with_created(member: Member, **kwargs):
+        pk, profile = ServerMember.identity(member)
+        sm, created = ServerMember.objects.get_or_create(id=pk, defaults={**profile, **kwargs})
+        ServerMember.update_identity(sm, profile, created)
         return sm, created
 
     @staticmethod
@@ -104,14 +135,9 @@ class ServerMember(ComputedFieldsModel):
 
     @staticmethod
     def from_tg_user_with_created(user: User, **kwargs):
-        sm, created = ServerMember.objects.get_or_create(id=-10**10 + user.id, defaults={
-            'name': user.full_name,
-            'username': user.username,
-        })
-        if not created:
-            if user.full_name != sm.name:
-                sm.name = user.full_name
-            sm.save()
+        pk, profile = ServerMember.identity(user)
+        sm, created = ServerMember.objects.get_or_create(id=pk, defaults=profile)
+        ServerMember.update_identity(sm, profile, created)
         return sm, created
 
     @staticmethod
@@ -128,25 +154,58 @@ class ServerMember(ComputedFieldsModel):
         if self.pk < 0:
             return
         if not self._dm_channel:
-            channel = get_api_session().post('https://discordapp.com/api/v6/users/@me/channels', json={
-                'recipient_id': self.id
-            }).json()
+            channel = create_dm_channel(self.id)
             self._dm_channel = channel['id']
-            self.save()
+            self.save(update_fields=('_dm_channel',))
         return self._dm_channel
 
+    @staticmethod
+    def adjust_balances(pk, allow_negative=False, **deltas):
+        # adds the deltas with one UPDATE that only matches when every balance with a negative delta covers it;
+        # returns {field: new value} or None when the funds are insufficient
+        fields = list(deltas)
+        assert set(fields) <= set(ServerMember.BALANCE_FIELDS)
+        qn = connection.ops.quote_name
+        sql = 'UPDATE {} SET {} WHERE {} = %s{} RETURNING {}'.format(
+            qn(ServerMember._meta.db_table),
+            ', '.join('{0} = {0} + %s'.format(qn(f)) for f in fields),
+            qn('id'),
+            ''.join(' AND {} >= %s'.format(qn(f)) for f in fields if deltas[f] < 0 and not allow_negative),
+            ', '.join(qn(f) for f in fields),
+        )
+        params = [deltas[f] for f in fields] + [pk] + \
+                 [-deltas[f] for f in fields if deltas[f] < 0 and not allow_negative]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return {f: ServerMember._meta.get_field(f).to_python(value) for f, value in zip(fields, row)}
+
+    def adjust(self, allow_negative=False, **deltas):
+        # see adjust_balances, updates the instance; returns whether the funds were sufficient
+        values = ServerMember.adjust_balances(self.pk, allow_negative, **deltas)
+        if values is None:
+            return False
+        for field, value in values.items():
+            setattr(self, field, value)
+        return True
+
     def send_message(self, content):
+        return Notification.objects.create(member=self, content=content)
+
+    def send_message_now(self, content):
         if self.id > 0:
-            send_discord_message(self.dm_channel, content)
+            return send_discord_message(self.dm_channel, content)
         else:
             from app.bot.telegram import get_bot
-            get_bot().send_message(self.pk + 10**10, content)
+            return get_bot().send_message(self.pk + 10**10, content)
 
     @property
     def wallet_address(self):
         if not self._wallet_address:
             self._wallet_address = client.create_address(str(self.pk))
-            self.save()
+            self.save(update_fields=('_wallet_address',))
         return self._wallet_address
 
     @property
@@ -161,14 +220,14 @@ class ServerMember(ComputedFieldsModel):
     def staking_wallet_address(self):
         if not self._staking_wallet_address:
             self._staking_wallet_address = staking_client.create_address(str(self.pk))
-            self.save()
+            self.save(update_fields=('_staking_wallet_address',))
         return self._staking_wallet_address
 
     @property
     def bitcoin_wallet_address(self):
         if not self._bitcoin_wallet_address:
             self._bitcoin_wallet_address = bitcoin_client.create_address(str(self.pk))
-            self.save()
+            self.save(update_fields=('_bitcoin_wallet_address',))
         return self._bitcoin_wallet_address
 
     def staking_unspent(self, minconf=None):
@@ -245,12 +304,17 @@ class ServerMember(ComputedFieldsModel):
     def update_investor_role(self):
         if self.pk < 0:
             return
+        is_investor = self.masternode_balance + self.staking_balance >= Decimal('100.')
+        if is_investor == self.is_investor:
+            return
         task = UpdateRoleTask(member=self)
-        if self.masternode_balance + self.staking_balance >= Decimal('100.'):
+        if is_investor:
             task.add_roles = global_preferences['ranks__investor_role_id']
         else:
             task.remove_roles = global_preferences['ranks__investor_role_id']
         task.save()
+        self.is_investor = is_investor
+        ServerMember.objects.filter(pk=self.pk).update(is_investor=is_investor)
 
         # m = get_member(global_preferences['general__guild_id'], self.pk)
         # sleep(1)
@@ -348,41 +412,13 @@ class TradeOrder(models.Model):
     amount = models.DecimalField(max_digits=32, decimal_places=8)
     btc_price = models.DecimalField(max_digits=32, decimal_places=8)
 
-    @transaction.atomic
-    def try_execution(self):
-        if self.is_sell:
-            competing = TradeOrder.objects.filter(amount__gt=0, is_sell=False, btc_price__gte=self.btc_price) \
-                .order_by('-btc_price').select_for_update()
-        else:
-            competing = TradeOrder.objects.filter(amount__gt=0, is_sell=True, btc_price__lte=self.btc_price) \
-                .order_by('btc_price').select_for_update()
-        for o in competing:
-            am = min(o.amount, self.amount)
-            pr = max(o.btc_price, self.btc_price) if self.is_sell else min(o.btc_price, self.btc_price)
-            o.amount -= am
-            o.save()
-            self.amount -= am
-            self.save()
-            buyer, seller = (o.member, self.member) if self.is_sell else (self.member, o.member)
-            buyer = ServerMember.objects.select_for_update().get(pk=buyer.pk)
-            seller = ServerMember.objects.select_for_update().get(pk=seller.pk)
-            if buyer.pk == seller.pk:
-                buyer = seller
-
-            buyer.balance += am
-            buyer.bitcoin_balance += (max(self.btc_price, o.btc_price) - pr) * am
-            buyer.save()
-            tx_logger.warning('BUY,{},+{:.8f}'.format(buyer, am))
-            buyer.send_message('Bought {:.8f} for {:.8f} BTC'.format(am, am * pr))
-
-            seller.bitcoin_balance += am * pr
-            seller.save()
-            seller.send_message('Sold {:.8f} for {:.8f} BTC'.format(am, am * pr))
-
-            OrderLog.objects.create(amount=am, btc_price=pr, is_sell=self.is_sell)
-
-            if not self.amount:
-                return
+    # new orders and cancel requests wait for the order_matcher, see app.exchange
+    pending = models.BooleanField(default=True)
+    cancel_requested = models.BooleanField(default=False, db_index=True)
+    created_at = models.DateTimeField(default=now)
+
+    class Meta:
+        index_together = ('pending', 'created_at'), ('is_sell', 'amount', 'btc_price')
 
 
 class OrderLog(models.Model):
@@ -392,6 +428,54 @@ class OrderLog(models.Model):
     is_sell = models.BooleanField(default=True)
 
 
+class Candle(models.Model):
+    # OHLCV bars built from OrderLog by the build_candles task
+    MINUTE = 60
+    HOUR = 60*60
+    DAY = 60*60*24
+    INTERVALS = (
+        (MINUTE, '1m'),
+        (HOUR, '1h'),
+        (DAY, '1d'),
+    )
+
+    interval = models.PositiveIntegerField(choices=INTERVALS)
+    start = models.DateTimeField()
+    open = models.DecimalField(max_digits=32, decimal_places=8)
+    high = models.DecimalField(max_digits=32, decimal_places=8)
+    low = models.DecimalField(max_digits=32, decimal_places=8)
+    close = models.DecimalField(max_digits=32, decimal_places=8)
+    volume = models.DecimalField(max_digits=32, decimal_places=8, default=0)
+    btc_volume = models.DecimalField(max_digits=32, decimal_places=8, default=0)
+    trades = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('interval', 'start'),
+
+    @staticmethod
+    def bucket_start(dt, interval):
+        ts = int(dt.timestamp())
+        return datetime.fromtimestamp(ts - ts % interval, utc)
+
+    @staticmethod
+    def summary(since):
+        # (high, low, volume, btc volume) since `since`: hourly bars, minute bars for the leading partial hour
+        hour = Candle.bucket_start(since, Candle.HOUR)
+        if hour < since:
+            hour += timedelta(seconds=Candle.HOUR)
+        bars = models.Q(interval=Candle.HOUR, start__gte=hour) | \
+            models.Q(interval=Candle.MINUTE, start__gte=Candle.bucket_start(since, Candle.MINUTE), start__lt=hour)
+        return Candle.objects.filter(bars).aggregate(
+            high=models.Max('high'), low=models.Min('low'),
+            volume=models.Sum('volume'), btc_volume=models.Sum('btc_volume'),
+        )
+
+    @staticmethod
+    def last_price():
+        c = Candle.objects.filter(interval=Candle.MINUTE).order_by('-start').first()
+        return c.close if c else 0
+
+
 class LotteryTicket(models.Model):
     member = models.ForeignKey(ServerMember, on_delete=models.CASCADE)
     value = models.PositiveSmallIntegerField()
@@ -446,7 +530,23 @@ class MasternodeBalanceLog(models.Model):
     member = models.ForeignKey(ServerMember, on_delete=models.CASCADE)
     delta = models.DecimalField(max_digits=32, decimal_places=8)
     balance = models.DecimalField(max_digits=32, decimal_places=8)
-    datetime = models.DateTimeField(default=now)
+    datetime = models.DateTimeField(default=now, db_index=True)
+    rolled_up = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        index_together = ('member', 'datetime'),
+
+
+class MasternodeBalanceDaily(models.Model):
+    # daily rollup of MasternodeBalanceLog, kept after raw rows are pruned
+    member = models.ForeignKey(ServerMember, on_delete=models.CASCADE, related_name='masternode_balance_days')
+    day = models.DateField(db_index=True)
+    delta_sum = models.DecimalField(max_digits=32, decimal_places=8, default=0)
+    balance = models.DecimalField(max_digits=32, decimal_places=8, default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('member', 'day'),
 
 
 class MNInvestTask(models.Model):
@@ -488,4 +588,120 @@ class TrackedMasternode(models.Model):
         return self.addr
 
 
+class BlockIndex(models.Model):
+    height = models.PositiveIntegerField(primary_key=True)
+    hash = models.CharField(max_length=64, unique=True)
+    time = models.DateTimeField(db_index=True)
+    pos_reward = models.DecimalField(max_digits=32, decimal_places=8, null=True, blank=True)
+    mn_reward = models.DecimalField(max_digits=32, decimal_places=8, null=True, blank=True)
+
+    def __str__(self):
+        return '#{} {}'.format(self.height, self.hash)
+
+
+class Notification(models.Model):
+    member = models.ForeignKey(ServerMember, on_delete=models.CASCADE, null=True, blank=True)
+    channel = models.BigIntegerField(null=True, blank=True)
+    content = models.TextField()
+    created_at = models.DateTimeField(default=now)
+    send_after = models.DateTimeField(default=now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    sent = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = ('sent', 'send_after'),
+
+    @staticmethod
+    def to_channel(channel, content):
+        return Notification.objects.create(channel=channel, content=content)
+
+    @property
+    def bucket(self):
+        if self.channel:
+            return 'channel', self.channel
+        return ('dm' if self.member_id > 0 else 'tg'), self.member_id
+
+
+class LedgerEntry(models.Model):
+    # every posting is a set of legs sharing `entry` whose deltas sum up to zero,
+    # member legs are on ServerMember balance fields, the rest on system accounts
+    SYSTEM_ACCOUNTS = {
+        'DEPOSIT': 'wallet',
+        'SEND': 'wallet',
+        'BTC_DEPOSIT': 'wallet',
+        'SENDBTC': 'wallet',
+        'STAKING': 'staking',
+        'MNINVEST': 'masternode',
+        'MNWITHDRAW': 'masternode',
+        'MNREWARD': 'masternode',
+        'POOLREWARD': 'staking',
+        'UNSTAKING': 'staking',
+        'RAIN': 'rain',
+        'TGRAIN_CREATE': 'rain',
+        'TGRAIN': 'rain',
+        'TGRAIN_RETURN': 'rain',
+        'AIRDROP': 'feeder',
+        'FEEDER': 'feeder',
+        'REFERRER_LVL1': 'feeder',
+        'REFERRER_LVL2': 'feeder',
+        'REFERRER_LVL3': 'feeder',
+        'LOTTERY': 'lottery',
+        'DICE': 'dice',
+        'SELL': 'exchange',
+        'BUY': 'exchange',
+        'CANCELORDER': 'exchange',
+        'USERNODE': 'usernode',
+    }
+
+    id = models.BigAutoField(primary_key=True)
+    entry = models.UUIDField(default=uuid4, db_index=True)
+    member = models.ForeignKey(ServerMember, on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='ledger_entries')
+    account = models.CharField(max_length=32)
+    kind = models.CharField(max_length=32)
+    delta = models.DecimalField(max_digits=32, decimal_places=8)
+    balance_after = models.DecimalField(max_digits=32, decimal_places=8, null=True, blank=True)
+    reference = models.CharField(max_length=128, null=True, blank=True)
+    datetime = models.DateTimeField(default=now)
+
+    class Meta:
+        index_together = ('member', 'datetime'), ('kind', 'datetime')
+
+    @staticmethod
+    def build(kind, *legs, reference=None):
+        # legs: (member, account, delta) or (None, system account, delta);
+        # whatever does not balance goes to the kind's system account, separately for SOVE and bitcoin
+        entry, ts = uuid4(), now()
+        legs = [leg for leg in legs if leg[2]]
+        rest = {}
+        for _, account, delta in legs:
+            currency = 'bitcoin_' if account.startswith('bitcoin') else ''
+            rest[currency] = rest.get(currency, 0) + delta
+        for currency, delta in rest.items():
+            if delta:
+                legs.append((None, currency + LedgerEntry.SYSTEM_ACCOUNTS[kind], -delta))
+        return [
+            LedgerEntry(entry=entry, member=member, account=account, kind=kind, delta=delta, reference=reference,
+                        balance_after=getattr(member, account) if member else None, datetime=ts)
+            for member, account, delta in legs
+        ]
+
+    @staticmethod
+    def log(entries):
+        for e in entries:
+            if e.member and e.account == 'balance':
+                line = '{},{},{}{:.8f}'.format(e.kind, e.member, '-' if e.delta < 0 else '+', abs(e.delta))
+                if e.reference:
+                    line += ',{}'.format(e.reference)
+                tx_logger.warning(line)
+
+    @staticmethod
+    def post(kind, *legs, reference=None):
+        # call after the member balances were changed, within the same transaction
+        entries = LedgerEntry.objects.bulk_create(LedgerEntry.build(kind, *legs, reference=reference))
+        LedgerEntry.log(entries)
+        return entries
 
+    def __str__(self):
+        return '{} {} {} {:+.8f}'.format(self.kind, self.member or self.account, self.account, self.delta)
@@ -0,0 +1,139 @@
+import time
+
+from django_redis import get_redis_connection
+
+# discord presence shared between the bot and the workers: ids of online members and of members per role
+ONLINE_KEY = 'presence:online'
+ROLES_KEY = 'presence:roles'
+ROLE_KEY = 'presence:role:{}'
+# online sessions {member id: start timestamp} and seconds online not yet folded into activity_counter
+SESSIONS_KEY = 'presence:sessions'
+ACTIVITY_KEY = 'presence:activity'
+FOLDING_KEY = 'presence:activity:folding'
+
+# credits the time since the session start; ARGV: member id, now, 1 to close the session or 0 to restart it
+CREDIT_SESSION = '''
+local start = redis.call('HGET', KEYS[1], ARGV[1])
+if start then
+    redis.call('HINCRBY', KEYS[2], ARGV[1], math.max(tonumber(ARGV[2]) - tonumber(start), 0))
+    if ARGV[3] == '1' then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    end
+end
+'''
+
+
+def redis():
+    return get_redis_connection('default')
+
+
+def set_online(member_id, online):
+    r = redis()
+    if online:
+        pipe = r.pipeline()
+        pipe.sadd(ONLINE_KEY, member_id)
+        pipe.hsetnx(SESSIONS_KEY, member_id, int(time.time()))
+        pipe.execute()
+    else:
+        r.srem(ONLINE_KEY, member_id)
+        r.eval(CREDIT_SESSION, 2, SESSIONS_KEY, ACTIVITY_KEY, member_id, int(time.time()), 1)
+
+
+def update_roles(member_id, removed, added):
+    pipe = redis().pipeline()
+    for role_id in removed:
+        pipe.srem(ROLE_KEY.format(role_id), member_id)
+    for role_id in added:
+        pipe.sadd(ROLE_KEY.format(role_id), member_id)
+    if added:
+        pipe.sadd(ROLES_KEY, *added)
+    pipe.execute()
+
+
+def remove_member(member_id, roles):
+    update_roles(member_id, roles, ())
+    set_online(member_id, False)
+
+
+def _replace(pipe, key, members):
+    # swaps the whole set at once, readers never see it half built
+    if members:
+        tmp = key + ':tmp'
+        pipe.delete(tmp)
+        pipe.sadd(tmp, *members)
+        pipe.rename(tmp, key)
+    else:
+        pipe.delete(key)
+
+
+def resync(online, roles):
+    # online: member ids, roles: {member id: role ids}; corrects whatever the events missed
+    r = redis()
+    by_role = {}
+    for member_id, member_roles in roles.items():
+        for role_id in member_roles:
+            by_role.setdefault(str(role_id), []).append(member_id)
+    stale = {role_id.decode() for role_id in r.smembers(ROLES_KEY)} - set(by_role)
+    online_ids = {str(member_id) for member_id in online}
+    sessions = {member_id.decode() for member_id in r.hkeys(SESSIONS_KEY)}
+    ts = int(time.time())
+    pipe = r.pipeline()
+    for member_id in online_ids - sessions:
+        pipe.hsetnx(SESSIONS_KEY, member_id, ts)
+    for member_id in sessions - online_ids:
+        pipe.eval(CREDIT_SESSION, 2, SESSIONS_KEY, ACTIVITY_KEY, member_id, ts, 1)
+    _replace(pipe, ONLINE_KEY, online)
+    for role_id, members in by_role.items():
+        _replace(pipe, ROLE_KEY.format(role_id), members)
+    for role_id in stale:
+        pipe.delete(ROLE_KEY.format(role_id))
+    _replace(pipe, ROLES_KEY, list(by_role))
+    pipe.execute()
+
+
+def online_members(exclude_role=None):
+    r = redis()
+    if exclude_role:
+        members = r.sdiff(ONLINE_KEY, ROLE_KEY.format(exclude_role))
+    else:
+        members = r.smembers(ONLINE_KEY)
+    return {int(m) for m in members}
+
+
+def online_count():
+    return redis().scard(ONLINE_KEY)
+
+
+def take_activity():
+    # {member id: seconds online} since the last call; open sessions are credited up to now.
+    # the taken hash stays in redis until release_activity, so a fold that fails before it is retried
+    r = redis()
+    if not r.exists(FOLDING_KEY):
+        ts = int(time.time())
+        pipe = r.pipeline()
+        for member_id in r.hkeys(SESSIONS_KEY):
+            pipe.eval(CREDIT_SESSION, 2, SESSIONS_KEY, ACTIVITY_KEY, member_id, ts, 0)
+        pipe.execute()
+        if not r.exists(ACTIVITY_KEY):
+            return {}
+        r.rename(ACTIVITY_KEY, FOLDING_KEY)
+    return {int(k): int(v) for k, v in r.hgetall(FOLDING_KEY).items()}
+
+
+def release_activity(remainders):
+    # remainders: {member id: seconds} too short to be credited yet
+    pipe = redis().pipeline()
+    for member_id, seconds in remainders.items():
+        pipe.hincrby(ACTIVITY_KEY, member_id, seconds)
+    pipe.delete(FOLDING_KEY)
+    pipe.execute()
+
+
+def restore_activity(seconds):
+    # undoes release_activity when the fold did not commit after all
+    pipe = redis().pipeline()
+    for member_id, s in seconds.items():
+        pipe.hincrby(ACTIVITY_KEY, member_id, s)
+    pipe.execute()
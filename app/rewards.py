@@ -0,0 +1,57 @@
+from decimal import Decimal, Context, localcontext, ROUND_DOWN
+
+from django.db.models import F, Value, DecimalField
+from django.db.models.functions import Floor
+from dynamic_preferences.registries import global_preferences_registry
+
+from app.models import ServerMember, LedgerEntry
+
+global_preferences = global_preferences_registry.manager()
+
+BALANCE_PLACES = Decimal('1e-8')
+RATIO_PLACES = Decimal('1e-18')
+DUST_PLACES = Decimal('1e-18')
+# wide enough for 32 digit balances times 18 digit ratios, so python and postgres agree exactly
+EXACT = Context(prec=80)
+
+
+def distribute_pro_rata(members, field, reward, dust_key, total=None):
+    # credits reward to `field` of the members proportionally to `field` with a single UPDATE.
+    # the reward is shared over `total` (the members' sum by default), what flooring to 8 places
+    # leaves behind is carried over in the `dust_key` preference and paid out with the next reward.
+    # must run inside a transaction, returns ([(pk, balance before, credit)], credited sum)
+    with localcontext(EXACT):
+        rows = list(members.select_for_update().values_list('pk', field))
+        balances_sum = sum(balance for _, balance in rows)
+        if not balances_sum:
+            return [], Decimal(0)
+        if total is None:
+            total = balances_sum
+
+        due = balances_sum * reward / total + global_preferences[dust_key]
+        ratio = (due / balances_sum).quantize(RATIO_PLACES, ROUND_DOWN)
+        credits = [(pk, balance, (balance * ratio).quantize(BALANCE_PLACES, ROUND_DOWN)) for pk, balance in rows]
+        credited = sum(credit for _, _, credit in credits)
+
+        ServerMember.objects.filter(pk__in=[pk for pk, _ in rows]).update(**{
+            field: F(field) + Floor(F(field) * Value(ratio / BALANCE_PLACES, output_field=DecimalField())) *
+            Value(BALANCE_PLACES, output_field=DecimalField())
+        })
+        global_preferences[dust_key] = (due - credited).quantize(DUST_PLACES, ROUND_DOWN)
+    return credits, credited
+
+
+def post_credits(kind, field, credits, reference=None):
+    # one ledger posting per distribution: a leg per credited member, balanced against the kind's system account
+    legs = [(ServerMember(pk=pk, **{field: balance + credit}), field, credit) for pk, balance, credit in credits]
+    LedgerEntry.objects.bulk_create(LedgerEntry.build(kind, *legs, reference=reference), batch_size=1000)
+
+
+def update_investor_roles(credits):
+    # credits only grow balances, so only members that are not investors yet can cross the threshold
+    candidates = ServerMember.objects.filter(pk__in=[pk for pk, _, credit in credits if credit])\
+        .exclude(is_investor=True)
+    for sm in candidates:  # type: ServerMember
+        if sm.is_investor is None or not sm.is_staking_pool or \
+                sm.masternode_balance + sm.staking_pool_amount >= Decimal('100.'):
+            sm.update_investor_role()
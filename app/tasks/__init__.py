@@ -16,3 +16,7 @@ from .usernode_rewards import usernode_rewards
 from .load_markets_data import load_markets_data
 from .execute_tgrain import execute_tgrain
 from .check_tracked_mns import check_tracked_mns
+from .index_blocks import index_blocks
+from .purge_role_tasks import purge_role_tasks
+from .rollup_masternode_balances import rollup_masternode_balances
+from .build_candles import build_candles
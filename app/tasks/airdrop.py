@@ -1,5 +1,4 @@
 import logging
-import json
 import traceback
 from time import sleep
 from decimal import Decimal
@@ -8,6 +7,7 @@ from django.db import transaction
 from django.db.models import Q
 from dynamic_preferences.registries import global_preferences_registry
 
+from app import presence
 from app.models import ServerMember, AirdropTask
 from evosbot.celery import app
 from evosbot.utils import tx_logger, fd, get_member
@@ -67,18 +67,13 @@ def airdrop(size):
     try:
         tasks = []
 
-        with open('/tmp/evos_online_with_roles.json') as f:
-            members = json.load(f)  # type: dict
-        # remove muted users
-        for mid, roles in members.copy().items():
-            if global_preferences['ranks__muted_role_id'] in roles:
-                del members[mid]
+        members = presence.online_members(exclude_role=global_preferences['ranks__muted_role_id'])
         for rank in [ServerMember.Rank.JUNIOR, ServerMember.Rank.EXPERIENCED, ServerMember.Rank.VETERAN,
                      ServerMember.Rank.GURU, ServerMember.Rank.SADHU]:
             amount = AIRDROP_AMOUNTS[size][rank]
             if not amount:
                 continue
-            rank_qs = ServerMember.objects.filter(Q(pk__in=members.keys()) | Q(pk__lt=0), rank=rank).distinct()\
+            rank_qs = ServerMember.objects.filter(Q(pk__in=members) | Q(pk__lt=0), rank=rank).distinct()\
                 .order_by('?')[:AIRDROP_COUNTS[size]].values_list('pk', flat=True)
             for pk in rank_qs:
                 holding_factor = Decimal(1.0)
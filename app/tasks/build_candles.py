@@ -0,0 +1,66 @@
+from celery_once import QueueOnce
+from django.db import transaction
+from django.db.models import Q
+from dynamic_preferences.registries import global_preferences_registry
+
+from app.models import OrderLog, Candle
+from evosbot.celery import app
+
+global_preferences = global_preferences_registry.manager()
+
+BATCH_SIZE = 10000
+
+
+def build_batch(cursor):
+    # returns the new cursor, or None when there are no new fills; OrderLog is written by the matcher only,
+    # so ids are committed in order
+    rows = list(OrderLog.objects.filter(pk__gt=cursor).order_by('pk')
+                .values_list('pk', 'datetime', 'amount', 'btc_price')[:BATCH_SIZE])
+    if not rows:
+        return None
+
+    bars = {}
+    for _, dt, amount, price in rows:
+        for interval, _ in Candle.INTERVALS:
+            key = interval, Candle.bucket_start(dt, interval)
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = Candle(interval=interval, start=key[1], open=price, high=price, low=price, close=price,
+                                   volume=amount, btc_volume=amount * price, trades=1)
+            else:
+                bar.high = max(bar.high, price)
+                bar.low = min(bar.low, price)
+                bar.close = price
+                bar.volume += amount
+                bar.btc_volume += amount * price
+                bar.trades += 1
+
+    with transaction.atomic():
+        condition = Q()
+        for interval, _ in Candle.INTERVALS:
+            condition |= Q(interval=interval, start__in=[start for i, start in bars if i == interval])
+        existing = {(c.interval, c.start): c for c in Candle.objects.filter(condition).select_for_update()}
+        updated = []
+        for key, bar in list(bars.items()):
+            c = existing.get(key)
+            if c is None:
+                continue
+            c.high = max(c.high, bar.high)
+            c.low = min(c.low, bar.low)
+            c.close = bar.close
+            c.volume += bar.volume
+            c.btc_volume += bar.btc_volume
+            c.trades += bar.trades
+            updated.append(c)
+            del bars[key]
+        Candle.objects.bulk_create(bars.values())
+        Candle.objects.bulk_update(updated, ('high', 'low', 'close', 'volume', 'btc_volume', 'trades'))
+        global_preferences['internal__candle_cursor'] = rows[-1][0]
+    return rows[-1][0]
+
+
+@app.task(name='app.tasks.build_candles', base=QueueOnce, once={'graceful': True})
+def build_candles():
+    cursor = global_preferences['internal__candle_cursor']
+    while cursor is not None:
+        cursor = build_batch(cursor)
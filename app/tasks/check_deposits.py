@@ -1,46 +1,101 @@
 from celery import shared_task
 from celery_once import QueueOnce
 from django.db import transaction
+from django.utils.timezone import now
+from dynamic_preferences.registries import global_preferences_registry
 
-from app.models import ServerMember
+from app.models import ServerMember, LedgerEntry
 from evosbot.celery import app
-from evosbot.utils import client, bitcoin_client, tx_logger
+from evosbot.utils import client, bitcoin_client
 
+global_preferences = global_preferences_registry.manager()
 
-@app.task(name='app.tasks.check_deposits', base=QueueOnce, once={'graceful': True})
-def check_deposits():
-    # update unconfirmed balances
-    for balance in client.received_by_address(0):
-        ServerMember.objects.filter(_wallet_address=balance['address']) \
-            .update(received_unconfirmed=balance['amount'])
+BULK_BATCH_SIZE = 500
+FULL_SCAN_MINUTE = 30
 
-    # update confirmed balances
-    for balance in client.received_by_address():
-        with transaction.atomic():
-            member = ServerMember.objects.filter(_wallet_address=balance['address']).select_for_update().first()  # type: ServerMember
-            if not member:
-                continue
-            if balance['amount'] > member.received:
-                delta = balance['amount'] - member.received
-                member.balance += delta
-                member.received = balance['amount']
-                member.save(update_fields=('balance', 'received',))
-                tx_logger.warning('DEPOSIT,{},+{:.8f}'.format(member, delta))
 
-    # BITCOIN
+def reconcile_deposits(address_field, received_field, unconfirmed_field, balance_field,
+                       confirmed, unconfirmed, kind):
+    # confirmed, unconfirmed: {address: total received}
+    addresses = set(confirmed) | set(unconfirmed)
+    if not addresses:
+        return
+    known = ServerMember.objects.filter(**{address_field + '__in': addresses}) \
+        .values_list('pk', address_field, received_field, unconfirmed_field)
+
+    unconfirmed_changed = []
+    received_changed = {}
+    for pk, address, received, received_unconfirmed in known:
+        if address in unconfirmed and unconfirmed[address] != received_unconfirmed:
+            unconfirmed_changed.append(ServerMember(pk=pk, **{unconfirmed_field: unconfirmed[address]}))
+        if address in confirmed and confirmed[address] > received:
+            received_changed[pk] = confirmed[address]
+
     # update unconfirmed balances
-    for balance in bitcoin_client.received_by_address(0):
-        ServerMember.objects.filter(_bitcoin_wallet_address=balance['address']) \
-            .update(bitcoin_received_unconfirmed=balance['amount'])
+    if unconfirmed_changed:
+        ServerMember.objects.bulk_update(unconfirmed_changed, (unconfirmed_field,), batch_size=BULK_BATCH_SIZE)
 
     # update confirmed balances
-    for balance in bitcoin_client.received_by_address():
-        with transaction.atomic():
-            member = ServerMember.objects.filter(_bitcoin_wallet_address=balance['address']).select_for_update().first()  # type: ServerMember
-            if not member:
+    if not received_changed:
+        return
+    with transaction.atomic():
+        members = []
+        entries = []
+        for member in ServerMember.objects.filter(pk__in=received_changed).select_for_update():  # type: ServerMember
+            amount = received_changed[member.pk]
+            received = getattr(member, received_field)
+            if amount <= received:
                 continue
-            if balance['amount'] > member.bitcoin_received:
-                delta = balance['amount'] - member.bitcoin_received
-                member.bitcoin_balance += delta
-                member.bitcoin_received = balance['amount']
-                member.save(update_fields=('bitcoin_balance', 'bitcoin_received',))
+            delta = amount - received
+            setattr(member, balance_field, getattr(member, balance_field) + delta)
+            setattr(member, received_field, amount)
+            members.append(member)
+            entries.extend(LedgerEntry.build(kind, (member, balance_field, delta)))
+        ServerMember.objects.bulk_update(members, (balance_field, received_field), batch_size=BULK_BATCH_SIZE)
+        LedgerEntry.log(LedgerEntry.objects.bulk_create(entries, batch_size=BULK_BATCH_SIZE))
+
+
+def received_amounts(rpc_client, confirmations=None):
+    return {balance['address']: balance['amount'] for balance in rpc_client.received_by_address(confirmations)}
+
+
+def cursor_block(rpc_client, confirmations):
+    # same block listsinceblock reports as lastblock for this target
+    height = max(rpc_client.api.getblockcount() - confirmations + 1, 0)
+    return rpc_client.api.getblockhash(height)
+
+
+def received_since(rpc_client, cursor_key, full=False):
+    confirmations = global_preferences['general__confirmations_needed']
+    cursor = global_preferences[cursor_key]
+
+    if full or not cursor:
+        next_cursor = cursor_block(rpc_client, confirmations)
+        confirmed = received_amounts(rpc_client, confirmations)
+        unconfirmed = received_amounts(rpc_client, 0)
+        return confirmed, unconfirmed, next_cursor
+
+    result = rpc_client.api.listsinceblock(cursor, confirmations)
+    addresses = list({tx['address'] for tx in result['transactions']
+                      if tx.get('category') == 'receive' and tx.get('address')})
+    amounts = rpc_client.batch([('getreceivedbyaddress', address, confirmations) for address in addresses] +
+                               [('getreceivedbyaddress', address, 0) for address in addresses])
+    confirmed = dict(zip(addresses, amounts[:len(addresses)]))
+    unconfirmed = dict(zip(addresses, amounts[len(addresses):]))
+    return confirmed, unconfirmed, result['lastblock']
+
+
+@app.task(name='app.tasks.check_deposits', base=QueueOnce, once={'graceful': True})
+def check_deposits(full=False):
+    # a full scan once an hour, in the same invocation so it never races the incremental one for the cursors
+    full = full or now().minute == FULL_SCAN_MINUTE
+    confirmed, unconfirmed, cursor = received_since(client, 'internal__last_deposit_block', full)
+    reconcile_deposits('_wallet_address', 'received', 'received_unconfirmed', 'balance',
+                       confirmed, unconfirmed, 'DEPOSIT')
+    global_preferences['internal__last_deposit_block'] = cursor
+
+    # BITCOIN
+    confirmed, unconfirmed, cursor = received_since(bitcoin_client, 'internal__last_bitcoin_deposit_block', full)
+    reconcile_deposits('_bitcoin_wallet_address', 'bitcoin_received', 'bitcoin_received_unconfirmed',
+                       'bitcoin_balance', confirmed, unconfirmed, 'BTC_DEPOSIT')
+    global_preferences['internal__last_bitcoin_deposit_block'] = cursor
@@ -1,11 +1,13 @@
 import logging
 from celery_once import QueueOnce
 from django.db import transaction
+from django.utils.timezone import now
 from dynamic_preferences.registries import global_preferences_registry
 
-from app.models import ServerMember, MasternodeBalanceLog
+from app.models import ServerMember, MasternodeBalanceLog, Notification
+from app.rewards import distribute_pro_rata, post_credits, update_investor_roles
 from evosbot.celery import app
-from evosbot.utils import masternode_client, send_discord_message, fd, get_masternode_price
+from evosbot.utils import masternode_client, fd, get_masternode_price
 
 global_preferences = global_preferences_registry.manager()
 
@@ -22,7 +24,11 @@ def check_masternode_rewards():
     txs = filter(lambda tx: tx.get('confirmations', 0) >= 0, lst['transactions'])
     generated_transactions = [tx for tx in txs if tx.get('generated') and tx['category'] == 'receive']
 
-    vouts_max = {}
+    reward_txids = list({tx['txid'] for tx in generated_transactions if tx['vout'] >= 1})
+    vouts_max = {
+        txid: max(vout['n'] for vout in decoded['vout'])
+        for txid, decoded in zip(reward_txids, masternode_client.decode_transactions(reward_txids))
+    }
     pos_txids = set()
     mn_rewards = 0
     min_confirmations = 999999999
@@ -33,10 +39,6 @@ def check_masternode_rewards():
 
         if tx['vout'] < 1:
             continue
-        if tx['txid'] not in vouts_max:
-            txhex = masternode_client.api.getrawtransaction(tx['txid'])
-            decoded = masternode_client.api.decoderawtransaction(txhex)
-            vouts_max[tx['txid']] = max(vout['n'] for vout in decoded['vout'])
         if tx['vout'] == vouts_max[tx['txid']]:
             mn_rewards += tx['amount']
         else:
@@ -54,21 +56,21 @@ def check_masternode_rewards():
 
     members = ServerMember.objects.filter(masternode_balance__gt=0)
 
-    summ = 0
-    trew = 0
     with transaction.atomic():
-        for sm in members.select_for_update():
-            reward = sm.masternode_balance / total_deposit * total_rewards
-            trew += reward
-            sm.masternode_balance += reward
-            summ += sm.masternode_balance
-            sm.save(update_fields=('masternode_balance',))
-            sm.update_investor_role()
-            MasternodeBalanceLog.objects.create(member=sm, balance=sm.masternode_balance, delta=reward)
+        credits, trew = distribute_pro_rata(members, 'masternode_balance', total_rewards,
+                                            'internal__masternode_dust', total=total_deposit)
+        ts = now()
+        MasternodeBalanceLog.objects.bulk_create([
+            MasternodeBalanceLog(member_id=pk, balance=balance + reward, delta=reward, datetime=ts)
+            for pk, balance, reward in credits
+        ], batch_size=1000)
+        post_credits('MNREWARD', 'masternode_balance', credits)
+        update_investor_roles(credits)
+    summ = sum(balance + reward for _, balance, reward in credits)
 
-    send_discord_message(global_preferences['general__reward_report_channel_id'],
-                         'Masternode rewards: {}\n'
-                         'Masternode staking rewards: {}\n'
-                         'Distributed among {} users'.format(fd(mn_rewards), fd(pos_rewards), members.count()))
+    Notification.to_channel(global_preferences['general__reward_report_channel_id'],
+                            'Masternode rewards: {}\n'
+                            'Masternode staking rewards: {}\n'
+                            'Distributed among {} users'.format(fd(mn_rewards), fd(pos_rewards), len(credits)))
 
     logging.warning('sharedmn USERS depo summ: {} wallet balance: {} diff: {} total_rewards: {} distributed: {}'.format(summ, masternode_client.api.getbalance(), masternode_client.api.getbalance()-summ, total_rewards, trew))
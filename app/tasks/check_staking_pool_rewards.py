@@ -1,12 +1,12 @@
 from celery import shared_task
 from celery_once import QueueOnce
 from django.db import transaction
-from django.db.models import Sum
 from dynamic_preferences.registries import global_preferences_registry
 
-from app.models import ServerMember
+from app.models import ServerMember, Notification
+from app.rewards import distribute_pro_rata, post_credits, update_investor_roles
 from evosbot.celery import app
-from evosbot.utils import staking_pool_client, send_discord_message, fd
+from evosbot.utils import staking_pool_client, fd
 
 global_preferences = global_preferences_registry.manager()
 
@@ -34,15 +34,12 @@ def check_staking_pool_rewards():
         return
     pool_members = ServerMember.objects.filter(staking_pool_amount__gt=0)\
         .exclude(unstakings__isnull=False, unstakings__fulfilled=False)
-    pool_sum = pool_members.aggregate(pool_sum=Sum('staking_pool_amount'))['pool_sum'] or 0
 
     with transaction.atomic():
-        for member in pool_members.select_for_update():
-            part = member.staking_pool_amount / pool_sum
-            member.staking_pool_amount += reward * part
-            member.save(update_fields=('staking_pool_amount',))
-            member.update_investor_role()
+        credits, _ = distribute_pro_rata(pool_members, 'staking_pool_amount', reward, 'internal__staking_pool_dust')
+        post_credits('POOLREWARD', 'staking_pool_amount', credits)
+        update_investor_roles(credits)
 
-    send_discord_message(global_preferences['general__reward_report_channel_id'],
-                         'Staking pool rewards: {}\n'
-                         'Distributed among {} users'.format(fd(reward), pool_members.count()))
+    Notification.to_channel(global_preferences['general__reward_report_channel_id'],
+                            'Staking pool rewards: {}\n'
+                            'Distributed among {} users'.format(fd(reward), len(credits)))
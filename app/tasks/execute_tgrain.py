@@ -4,9 +4,9 @@ from decimal import getcontext
 from django.db import transaction
 from telegram.utils.helpers import mention_markdown
 
-from app.models import TGRainTask, ServerMember
+from app.models import TGRainTask, ServerMember, LedgerEntry
 from evosbot.celery import app
-from evosbot.utils import tx_logger, fd
+from evosbot.utils import fd
 
 
 @app.task(name='app.tasks.execute_tgrain')
@@ -18,9 +18,8 @@ def execute_tgrain(task_id):
         if not t.users:
             t.finished = True
             t.save()
-            t.member.balance += t.amount
-            t.member.save(update_fields=('balance',))
-            tx_logger.warning('TGRAIN_RETURN,{},{:.8f}'.format(t.member, t.amount))
+            t.member.adjust(balance=t.amount)
+            LedgerEntry.post('TGRAIN_RETURN', (t.member, 'balance', t.amount), reference=t.pk)
             get_bot().edit_message_text(chat_id=t.chat_id,
                                         message_id=t.message_id,
                                         text='Nobody participated in this rain', reply_markup=None)
@@ -34,11 +33,10 @@ def execute_tgrain(task_id):
         awarded_users = []
         for uid in users:
             try:
-                sm = ServerMember.objects.select_for_update().get(pk=int(uid) - 10**10)
-                sm.balance += reward_each
-                sm.save(update_fields=('balance',))
+                sm = ServerMember.objects.get(pk=int(uid) - 10**10)
+                sm.adjust(balance=reward_each)
                 awarded_users.append(mention_markdown(int(uid), sm.name))
-                tx_logger.warning('TGRAIN,{},{:.8f}'.format(sm, reward_each))
+                LedgerEntry.post('TGRAIN', (sm, 'balance', reward_each), reference=t.pk)
                 not sm.noinform and sm.send_message('You have been rained the amount of {} SOVE'.format(fd(reward_each)))
             except:
                 pass
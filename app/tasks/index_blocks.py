@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+from celery_once import QueueOnce
+from django.db import transaction
+from django.utils.timezone import now, utc
+
+from app.models import BlockIndex
+from evosbot.celery import app
+from evosbot.utils import client, get_blocks_rewards
+
+BACKFILL_BLOCKS = 60 * 24 * 2
+BATCH_SIZE = 200
+RETENTION = timedelta(30)
+
+
+@app.task(name='app.tasks.index_blocks', base=QueueOnce, once={'graceful': True})
+def index_blocks():
+    best_height = client.api.getblockcount()
+
+    # forget blocks that were reorganized away, including those above the tip of a shorter chain
+    BlockIndex.objects.filter(height__gt=best_height).delete()
+    last = BlockIndex.objects.order_by('-height').first()
+    while last and client.api.getblockhash(last.height) != last.hash:
+        BlockIndex.objects.filter(height__gte=last.height).delete()
+        last = BlockIndex.objects.order_by('-height').first()
+
+    start = last.height + 1 if last else max(best_height - BACKFILL_BLOCKS, 1)
+    for batch_start in range(start, best_height + 1, BATCH_SIZE):
+        heights = range(batch_start, min(batch_start + BATCH_SIZE, best_height + 1))
+        blocks = client.get_blocks(client.batch([('getblockhash', h) for h in heights]))
+        rows = [
+            BlockIndex(height=h, hash=b['hash'], time=datetime.fromtimestamp(b['time'], utc),
+                       pos_reward=pos_reward, mn_reward=mn_reward)
+            for h, b, (pos_reward, mn_reward) in zip(heights, blocks, get_blocks_rewards(client, blocks))
+        ]
+        with transaction.atomic():
+            BlockIndex.objects.bulk_create(rows)
+
+    BlockIndex.objects.filter(time__lt=now() - RETENTION).delete()
@@ -5,9 +5,9 @@ from celery_once import QueueOnce
 from django.db import transaction
 from dynamic_preferences.registries import global_preferences_registry
 
-from app.models import LotteryTicket, ServerMember
+from app.models import LotteryTicket, Notification, LedgerEntry
 from evosbot.celery import app
-from evosbot.utils import client, send_discord_message, tx_logger, fd, RPCClient
+from evosbot.utils import client, fd, RPCClient
 
 global_preferences = global_preferences_registry.manager()
 
@@ -41,35 +41,34 @@ def lottery():
         winners = winning_tickets.count()
         bot_winners = len(list(filter(lambda i: i == value, bots)))
         if not winners and not bot_winners:
-            send_discord_message(global_preferences['games__games_channel_id'],
-                                 'Lottery results\n'
-                                 'Block hash: `{}`\n'
-                                 'Winning value: 0x{} = {}    '
-                                 '**No winners**\n'
-                                 'Jackpot of {} was preserved'.format(block_hash, hex_value, value,
-                                                                      fd(global_preferences['internal__lottery_jackpot'])))
+            Notification.to_channel(global_preferences['games__games_channel_id'],
+                                    'Lottery results\n'
+                                    'Block hash: `{}`\n'
+                                    'Winning value: 0x{} = {}    '
+                                    '**No winners**\n'
+                                    'Jackpot of {} was preserved'.format(block_hash, hex_value, value,
+                                                                         fd(global_preferences['internal__lottery_jackpot'])))
         else:
             win_amount = global_preferences['internal__lottery_jackpot'] / (winners + bot_winners)
             winner_members = set()
-            for ticket in winning_tickets:  # type: LotteryTicket
+            for ticket in winning_tickets.select_related('member'):  # type: LotteryTicket
                 with transaction.atomic():
-                    member = ServerMember.objects.select_for_update().get(pk=ticket.member_id)
-                    member.balance += win_amount
-                    member.save(update_fields=('balance',))
-                    tx_logger.warning('LOTTERY,{},+{:.8f}'.format(member, win_amount))
+                    member = ticket.member
+                    member.adjust(balance=win_amount)
+                    LedgerEntry.post('LOTTERY', (member, 'balance', win_amount), reference=block_hash)
                     winner_members.add(member)
             global_preferences['general__feeder_balance'] += bot_winners * win_amount
 
-            send_discord_message(global_preferences['games__games_channel_id'],
-                                 'Lottery results\n'
-                                 'Block hash: `{}`\n'
-                                 'Winning value: 0x{} = {}    '
-                                 '{} **winners:** {}\n'
-                                 'Win amounts: {} SOVE'.format(
-                                     block_hash, hex_value, value, winners + bot_winners,
-                                     ', '.join([t.member.name for t in winning_tickets] + (['Bot'] * bot_winners)),
-                                     fd(win_amount)
-                                 ))
+            Notification.to_channel(global_preferences['games__games_channel_id'],
+                                    'Lottery results\n'
+                                    'Block hash: `{}`\n'
+                                    'Winning value: 0x{} = {}    '
+                                    '{} **winners:** {}\n'
+                                    'Win amounts: {} SOVE'.format(
+                                        block_hash, hex_value, value, winners + bot_winners,
+                                        ', '.join([t.member.name for t in winning_tickets] + (['Bot'] * bot_winners)),
+                                        fd(win_amount)
+                                    ))
 
             global_preferences['internal__lottery_jackpot'] = Decimal(0)
         tickets.delete()
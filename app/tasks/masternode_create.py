@@ -8,7 +8,8 @@ from dynamic_preferences.registries import global_preferences_registry
 
 from app.models import Masternode
 from evosbot.celery import app
-from evosbot.utils import masternode_client, get_masternode_price, masternode_address, RPCClient
+from evosbot.utils import masternode_client, get_masternode_price, masternode_address, RPCClient, \
+    invalidate_masternode_price
 
 global_preferences = global_preferences_registry.manager()
 global_preferences['internal__masternode_lock'] = False
@@ -26,13 +27,11 @@ def masternode_create():
             logging.warning('No unused masternodes')
             return
 
-        masternode_price = get_masternode_price()
+        masternode_price = get_masternode_price(refresh=True)
 
         masternode_txids = Masternode.objects.filter(active=True).values_list('output_txid', 'output_idx')
         locked = [tx for tx in masternode_client.api.listlockunspent() if (tx['txid'], tx['vout']) not in masternode_txids]
-        for l in locked:
-            tx = masternode_client.api.decoderawtransaction(masternode_client.api.getrawtransaction(l['txid']))
-            l['amount'] = tx['vout'][l['vout']]['value']
+        masternode_client.fill_locked_amounts(locked)
         unspent = [tx for tx in masternode_client.api.listunspent(0) if (tx['txid'], tx['vout']) not in masternode_txids]
         sum_unspent = sum(u['amount'] for u in locked + unspent)
 
@@ -71,6 +70,7 @@ def masternode_create():
         mn.output_idx = outputidx
         mn.active = True
         mn.save()
+        invalidate_masternode_price()
 
         r = requests.post(global_preferences['general__masternode_service_uri'] + '/config', json={
             'content': Masternode.generate_config(),
@@ -10,7 +10,8 @@ from dynamic_preferences.registries import global_preferences_registry
 
 from app.models import MasternodeWithdraw, Masternode
 from evosbot.celery import app
-from evosbot.utils import masternode_client, masternode_address, get_masternode_price, RPCClient
+from evosbot.utils import masternode_client, masternode_address, get_masternode_price, RPCClient, \
+    invalidate_masternode_price
 
 global_preferences = global_preferences_registry.manager()
 
@@ -22,16 +23,14 @@ def process_mn_withdraws():
 
     try:
         global_preferences['internal__masternode_lock'] = True
+        masternode_price = get_masternode_price(refresh=True)
         for mnw in MasternodeWithdraw.objects.filter(fulfilled=False, fulfill_at__lte=now()):  # type: MasternodeWithdraw
             try:
                 sm = mnw.member
 
-                masternode_price = get_masternode_price()
                 masternode_txids = Masternode.objects.filter(active=True).values_list('output_txid', 'output_idx')
                 locked = [tx for tx in masternode_client.api.listlockunspent() if (tx['txid'], tx['vout']) not in masternode_txids]
-                for l in locked:
-                    tx = masternode_client.api.decoderawtransaction(masternode_client.api.getrawtransaction(l['txid']))
-                    l['amount'] = tx['vout'][l['vout']]['value']
+                masternode_client.fill_locked_amounts(locked)
 
                 unspents = masternode_client.api.listunspent(0)
                 unspents_sum = sum(b['amount'] for b in locked + unspents)
@@ -54,6 +53,7 @@ def process_mn_withdraws():
                             mn.save()
                             if unspents_sum >= mnw.amount:
                                 break
+                        invalidate_masternode_price()
                         r1 = requests.post(global_preferences['general__masternode_service_uri'] + '/config', json={
                             'content': Masternode.generate_config(),
                         })
@@ -3,9 +3,10 @@ import math
 import traceback
 
 from celery_once import QueueOnce
+from django.db import transaction
 from django.utils.timezone import now
 
-from app.models import Unstaking
+from app.models import Unstaking, LedgerEntry
 from evosbot.celery import app
 from evosbot.utils import staking_pool_client, staking_pool_address, RPCClient
 
@@ -17,10 +18,7 @@ def process_unstaking():
         try:
             sm = u.member
             if sm.is_staking_pool:
-                locked = spc.api.listlockunspent()
-                for l in locked:
-                    tx = spc.api.decoderawtransaction(spc.api.getrawtransaction(l['txid']))
-                    l['amount'] = tx['vout'][l['vout']]['value']
+                locked = spc.fill_locked_amounts(spc.api.listlockunspent())
 
                 unspents = spc.api.listunspent(0)
                 unspents_sum = sum(b['amount'] for b in locked + unspents)
@@ -59,10 +57,12 @@ def process_unstaking():
                         return
                     raise
                 sm.send_message('{} SOVE was unstacked\ntxid: `{}`'.format(u.amount, txid))
-                sm.staking_pool_amount -= u.amount
-                sm.save(update_fields=('staking_pool_amount',))
-                u.fulfilled = True
-                u.save()
+                with transaction.atomic():
+                    # the coins are already sent
+                    sm.adjust(allow_negative=True, staking_pool_amount=-u.amount)
+                    LedgerEntry.post('UNSTAKING', (sm, 'staking_pool_amount', -u.amount), reference=txid)
+                    u.fulfilled = True
+                    u.save()
                 spc.api.lockunspent(True, locked)
         except:
             traceback.print_exc()
@@ -0,0 +1,15 @@
+from celery_once import QueueOnce
+
+from app.models import UpdateRoleTask
+from evosbot.celery import app
+
+PURGE_BATCH_SIZE = 10000
+
+
+@app.task(name='app.tasks.purge_role_tasks', base=QueueOnce, once={'graceful': True})
+def purge_role_tasks():
+    while True:
+        pks = list(UpdateRoleTask.objects.filter(processed=True).values_list('pk', flat=True)[:PURGE_BATCH_SIZE])
+        if not pks:
+            break
+        UpdateRoleTask.objects.filter(pk__in=pks).delete()
@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+from celery_once import QueueOnce
+from django.db import transaction
+from django.utils.timezone import now, localtime
+from dynamic_preferences.registries import global_preferences_registry
+
+from app.models import MasternodeBalanceLog, MasternodeBalanceDaily
+from evosbot.celery import app
+
+global_preferences = global_preferences_registry.manager()
+
+BATCH_SIZE = 10000
+PRUNE_BATCH_SIZE = 10000
+
+
+def rollup_batch():
+    # rows are marked as rolled up in the same transaction, so rows committed late are picked up by a later run;
+    # returns whether there was anything to roll up
+    rows = list(MasternodeBalanceLog.objects.filter(rolled_up=False).order_by('pk')
+                .values_list('pk', 'member_id', 'delta', 'balance', 'datetime')[:BATCH_SIZE])
+    if not rows:
+        return False
+
+    days = {}
+    for pk, member_id, delta, balance, dt in rows:
+        key = member_id, localtime(dt).date()
+        delta_sum, _, entries = days.get(key, (0, None, 0))
+        days[key] = delta_sum + delta, balance, entries + 1
+
+    with transaction.atomic():
+        existing = {
+            (d.member_id, d.day): d
+            for d in MasternodeBalanceDaily.objects
+            .filter(member_id__in={m for m, _ in days}, day__in={day for _, day in days})
+            .select_for_update()
+        }
+        created, updated = [], []
+        for (member_id, day), (delta_sum, balance, entries) in days.items():
+            d = existing.get((member_id, day))
+            if d is None:
+                created.append(MasternodeBalanceDaily(member_id=member_id, day=day, delta_sum=delta_sum,
+                                                      balance=balance, entries=entries))
+            else:
+                d.delta_sum += delta_sum
+                d.balance = balance
+                d.entries += entries
+                updated.append(d)
+        MasternodeBalanceDaily.objects.bulk_create(created)
+        MasternodeBalanceDaily.objects.bulk_update(updated, ('delta_sum', 'balance', 'entries'))
+        MasternodeBalanceLog.objects.filter(pk__in=[row[0] for row in rows]).update(rolled_up=True)
+    return True
+
+
+def prune_raw_rows():
+    days = global_preferences['general__masternode_log_retention']
+    if days <= 0:
+        return
+    # only rows that are already rolled up
+    qs = MasternodeBalanceLog.objects.filter(rolled_up=True, datetime__lt=now() - timedelta(days))
+    while True:
+        pks = list(qs.values_list('pk', flat=True)[:PRUNE_BATCH_SIZE])
+        if not pks:
+            break
+        MasternodeBalanceLog.objects.filter(pk__in=pks).delete()
+
+
+@app.task(name='app.tasks.rollup_masternode_balances', base=QueueOnce, once={'graceful': True})
+def rollup_masternode_balances():
+    while rollup_batch():
+        pass
+    prune_raw_rows()
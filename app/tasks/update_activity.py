@@ -1,22 +1,60 @@
-import json
-import traceback
+import time
 
 from celery_once import QueueOnce
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import F
 from dynamic_preferences.registries import global_preferences_registry
 
+from app import presence
 from app.models import ServerMember
 from evosbot.celery import app
 
 global_preferences = global_preferences_registry.manager()
 
+TELEGRAM_FOLD_KEY = 'activity:telegram_folded'
+UPDATE_BATCH_SIZE = 5000
+
+
+def telegram_minutes():
+    # telegram has no presence, its members are credited every minute since the last fold;
+    # returns (minutes, fold timestamp to store once they are written)
+    ts = time.time()
+    folded = cache.get(TELEGRAM_FOLD_KEY)
+    if folded is None:
+        return 0, ts
+    minutes = int((ts - folded) // 60)
+    return minutes, folded + minutes * 60
+
 
 @app.task(name='app.tasks.update_activity', base=QueueOnce, once={'graceful': True})
 def update_activity():
+    # folds the online time of discord sessions into activity_counter (in minutes), one UPDATE per credited amount
+    seconds = presence.take_activity()
+    groups = {}
+    remainders = {}
+    for member_id, s in seconds.items():
+        minutes, remainders[member_id] = divmod(s, 60)
+        if minutes:
+            groups.setdefault(minutes, []).append(member_id)
+
+    tg_minutes, tg_folded = telegram_minutes()
+    released = False
     try:
-        with open('/tmp/evos_online.json') as f:
-            members = json.load(f)
-        ServerMember.objects.filter(pk__in=members).update(activity_counter=F('activity_counter') + 1)
-        ServerMember.objects.filter(pk__lt=0).update(activity_counter=F('activity_counter') + 1)
-    except:
-        traceback.print_exc()
+        with transaction.atomic():
+            for minutes, pks in groups.items():
+                for i in range(0, len(pks), UPDATE_BATCH_SIZE):
+                    ServerMember.objects.filter(pk__in=pks[i:i + UPDATE_BATCH_SIZE]) \
+                        .update(activity_counter=F('activity_counter') + minutes)
+            if tg_minutes:
+                ServerMember.objects.filter(pk__lt=0).update(activity_counter=F('activity_counter') + tg_minutes)
+            # released before the commit, so a failure in between loses at most this fold instead of repeating it
+            cache.set(TELEGRAM_FOLD_KEY, tg_folded, None)
+            presence.release_activity({member_id: s for member_id, s in remainders.items() if s})
+            released = True
+    except Exception:
+        if released:
+            presence.restore_activity({member_id: minutes * 60 for minutes, pks in groups.items() for member_id in pks})
+            if tg_minutes:
+                cache.set(TELEGRAM_FOLD_KEY, tg_folded - tg_minutes * 60, None)
+        raise
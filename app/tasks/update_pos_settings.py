@@ -14,16 +14,11 @@ global_preferences = global_preferences_registry.manager()
 @app.task(name='app.tasks.update_pos_settings', base=QueueOnce, once={'graceful': True})
 def update_pos_settings():
     last_block_num = staking_pool_client.api.getblockcount()
+    hashes = staking_pool_client.batch([('getblockhash', bn) for bn in range(last_block_num, last_block_num - 120, -1)])
+    blocks = staking_pool_client.get_blocks(bh for bh in hashes if not bh.startswith('0000'))
+    txids = [b['tx'][1] for b in blocks if len(b['tx']) >= 2]
     vals = []
-    for bn in range(last_block_num, last_block_num - 120, -1):
-        bh = staking_pool_client.api.getblockhash(bn)
-        if bh.startswith('0000'):
-            continue
-        b = staking_pool_client.api.getblock(bh)
-        if len(b['tx']) < 2:
-            continue
-        rtx = staking_pool_client.api.getrawtransaction(b['tx'][1])
-        tx = staking_pool_client.api.decoderawtransaction(rtx)
+    for tx in staking_pool_client.decode_transactions(txids):
         if len(tx['vout']) < 2:
             continue
         vals.append(tx['vout'][1]['value'])
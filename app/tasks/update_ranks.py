@@ -1,274 +1,49 @@
-import logging
-from time import sleep
 from datetime import timedelta
 
 from celery_once import QueueOnce
-from django.db.models import F, Q
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, IntegerField, BigIntegerField, DecimalField, OuterRef, \
+    Subquery, Count
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 from dynamic_preferences.registries import global_preferences_registry
 
-from app.models import ServerMember, UpdateRoleTask
+from app.models import ServerMember, UpdateRoleTask, Notification, LedgerEntry
 from evosbot.celery import app
-from evosbot.utils import set_roles, get_member, tx_logger, rank_logger, send_discord_message
+from evosbot.utils import rank_logger
 
 global_preferences = global_preferences_registry.manager()
 Rank = ServerMember.Rank
 
+DAY = 60*24
 
-@app.task(name='app.tasks.update_ranks', base=QueueOnce, once={'graceful': True})
-def update_ranks():
-    new_promotes = {}
-    new_demotes = {}
-
-    telegram_multiplier = global_preferences['ranks__telegram_rank_multiplier']
-
-    # promote
-    qs = ServerMember.objects.filter(
-        pk__gte=0,
-        rank=Rank.BRAND_NEW,
-        xp__gt=0,
-        activity_counter__gte=60*24 * telegram_multiplier
-    ) | ServerMember.objects.filter(
-        pk__lt=0,
-        rank=Rank.BRAND_NEW,
-        xp__gt=0,
-        activity_counter__gte=60*24 * telegram_multiplier
-    )
-    for sm in qs:
-        referrer = sm.referrer
-        if referrer:
-            lvl1_bonus = global_preferences['ranks__referrer_lvl1_bonus']
-            if lvl1_bonus and global_preferences['general__feeder_balance'] >= lvl1_bonus:
-                global_preferences['general__feeder_balance'] -= lvl1_bonus
-                referrer.balance += lvl1_bonus
-                referrer.save(update_fields=('balance',))
-                tx_logger.warning('REFERRER_LVL1,{},+{:.8f}'.format(sm, lvl1_bonus))
-                sm.send_message('You have been awarded {:.8f} for inviting a user (level 1)'.format(lvl1_bonus))
-            if referrer.referrer:
-                lvl2_bonus = global_preferences['ranks__referrer_lvl2_bonus']
-                if lvl2_bonus and global_preferences['general__feeder_balance'] >= lvl2_bonus:
-                    global_preferences['general__feeder_balance'] -= lvl2_bonus
-                    referrer.referrer.balance += lvl2_bonus
-                    referrer.referrer.save(update_fields=('balance',))
-                    tx_logger.warning('REFERRER_LVL2,{},+{:.8f}'.format(sm, lvl2_bonus))
-                    sm.send_message('You have been awarded {:.8f} for inviting a user (level 2)'.format(lvl2_bonus))
-                if referrer.referrer.referrer:
-                    lvl3_bonus = global_preferences['ranks__referrer_lvl3_bonus']
-                    if lvl3_bonus and global_preferences['general__feeder_balance'] >= lvl3_bonus:
-                        global_preferences['general__feeder_balance'] -= lvl3_bonus
-                        referrer.referrer.referrer.balance += lvl3_bonus
-                        referrer.referrer.referrer.save(update_fields=('balance',))
-                        tx_logger.warning('REFERRER_LVL3,{},+{:.8f}'.format(sm, lvl3_bonus))
-                        sm.send_message('You have been awarded {:.8f} for inviting a user (level 3)'.format(lvl3_bonus))
-    new_promotes.setdefault(Rank.NEWBIE, []).extend(qs)
-    qs.update(
-        rank=Rank.NEWBIE,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-
-    qs = ServerMember.objects.filter(
-        pk__gte=0,
-        rank=Rank.NEWBIE,
-        xp__gte=global_preferences['ranks__junior_xp'],
-        activity_counter__gte=60*24*3
-    )
-    qs_tg = ServerMember.objects.filter(
-        pk__lt=0,
-        rank=Rank.NEWBIE,
-        xp__gte=global_preferences['ranks__junior_xp'] * telegram_multiplier,
-        activity_counter__gte=60*24*3 * telegram_multiplier
-    )
-    new_promotes.setdefault(Rank.JUNIOR, []).extend(qs | qs_tg)
-    qs.update(
-        rank=Rank.JUNIOR,
-        xp=F('xp') - global_preferences['ranks__junior_xp'],
-        activity_counter=F('activity_counter') - 60*24*3,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-    qs_tg.update(
-        rank=Rank.JUNIOR,
-        xp=F('xp') - global_preferences['ranks__junior_xp'] * telegram_multiplier,
-        activity_counter=F('activity_counter') - 60*24*3 * telegram_multiplier,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-
-    qs = ServerMember.objects.filter(
-        pk__gte=0,
-        rank=Rank.JUNIOR,
-        xp__gte=global_preferences['ranks__experienced_xp'],
-        activity_counter__gte=60*24*5
-    )
-    qs_tg = ServerMember.objects.filter(
-        pk__lt=0,
-        rank=Rank.JUNIOR,
-        xp__gte=global_preferences['ranks__experienced_xp'] * telegram_multiplier,
-        activity_counter__gte=60*24*5 * telegram_multiplier
-    )
-    new_promotes.setdefault(Rank.EXPERIENCED, []).extend(qs | qs_tg)
-    qs.update(
-        rank=Rank.EXPERIENCED,
-        xp=F('xp') - global_preferences['ranks__experienced_xp'],
-        activity_counter=F('activity_counter') - 60*24*5,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-    qs_tg.update(
-        rank=Rank.EXPERIENCED,
-        xp=F('xp') - global_preferences['ranks__experienced_xp'] * telegram_multiplier,
-        activity_counter=F('activity_counter') - 60*24*5 * telegram_multiplier,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-
-    qs = ServerMember.objects.filter(
-        pk__gte=0,
-        rank=Rank.EXPERIENCED,
-        xp__gte=global_preferences['ranks__veteran_xp'],
-        activity_counter__gte=60*24*8
-    )
-    qs_tg = ServerMember.objects.filter(
-        pk__lt=0,
-        rank=Rank.EXPERIENCED,
-        xp__gte=global_preferences['ranks__veteran_xp'] * telegram_multiplier,
-        activity_counter__gte=60*24*8 * telegram_multiplier
-    )
-    new_promotes.setdefault(Rank.VETERAN, []).extend(qs | qs_tg)
-    qs.update(
-        rank=Rank.VETERAN,
-        xp=F('xp') - global_preferences['ranks__veteran_xp'],
-        activity_counter=F('activity_counter') - 60*24*8,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-    qs_tg.update(
-        rank=Rank.VETERAN,
-        xp=F('xp') - global_preferences['ranks__veteran_xp'] * telegram_multiplier,
-        activity_counter=F('activity_counter') - 60*24*8 * telegram_multiplier,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-
-    qs = ServerMember.objects.filter(
-        pk__gte=0,
-        rank=Rank.VETERAN,
-        xp__gte=global_preferences['ranks__guru_xp'],
-        activity_counter__gte=60*24*14
-    )
-    qs_tg = ServerMember.objects.filter(
-        pk__lt=0,
-        rank=Rank.VETERAN,
-        xp__gte=global_preferences['ranks__guru_xp'] * telegram_multiplier,
-        activity_counter__gte=60*24*14 * telegram_multiplier
-    )
-    new_promotes.setdefault(Rank.GURU, []).extend(qs | qs_tg)
-    qs.update(
-        rank=Rank.GURU,
-        xp=F('xp') - global_preferences['ranks__guru_xp'],
-        activity_counter=F('activity_counter') - 60*24*14,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-    qs_tg.update(
-        rank=Rank.GURU,
-        xp=F('xp') - global_preferences['ranks__guru_xp'] * telegram_multiplier,
-        activity_counter=F('activity_counter') - 60*24*14 * telegram_multiplier,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
-
-    # demote
-    qs = ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__experienced_xp'] / 5) | Q(activity_counter__lt=60*24),
-        pk__gte=0,
-        rank=Rank.JUNIOR,
-        last_rank_change__lt=now() - timedelta(4)
-    ) | ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__experienced_xp'] * telegram_multiplier / 5) | Q(activity_counter__lt=60*24 * telegram_multiplier),
-        pk__lt=0,
-        rank=Rank.JUNIOR,
-        last_rank_change__lt=now() - timedelta(4)
-    )
-    new_demotes.setdefault(Rank.NEWBIE, []).extend(qs)
-    qs.update(
-        rank=Rank.NEWBIE,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
+# (rank, new rank, xp preference, activity days); xp and activity are spent on promotion
+PROMOTIONS = (
+    (Rank.NEWBIE, Rank.JUNIOR, 'ranks__junior_xp', 3),
+    (Rank.JUNIOR, Rank.EXPERIENCED, 'ranks__experienced_xp', 5),
+    (Rank.EXPERIENCED, Rank.VETERAN, 'ranks__veteran_xp', 8),
+    (Rank.VETERAN, Rank.GURU, 'ranks__guru_xp', 14),
+)
 
-    qs = ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__veteran_xp'] / 6) | Q(activity_counter__lt=60*24),
-        pk__gte=0,
-        rank=Rank.EXPERIENCED,
-        last_rank_change__lt=now() - timedelta(6)
-    ) | ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__veteran_xp'] * telegram_multiplier / 6) | Q(activity_counter__lt=60*24 * telegram_multiplier),
-        pk__lt=0,
-        rank=Rank.EXPERIENCED,
-        last_rank_change__lt=now() - timedelta(6)
-    )
-    new_demotes.setdefault(Rank.JUNIOR, []).extend(qs)
-    qs.update(
-        rank=Rank.JUNIOR,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
+# (rank, new rank, xp preference, xp divisor, hold days)
+DEMOTIONS = (
+    (Rank.JUNIOR, Rank.NEWBIE, 'ranks__experienced_xp', 5, 4),
+    (Rank.EXPERIENCED, Rank.JUNIOR, 'ranks__veteran_xp', 6, 6),
+    (Rank.VETERAN, Rank.EXPERIENCED, 'ranks__guru_xp', 10, 8),
+    (Rank.GURU, Rank.VETERAN, 'ranks__sadhu_xp', 20, 10),
+)
 
-    qs = ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__guru_xp'] / 10) | Q(activity_counter__lt=60*24),
-        pk__gte=0,
-        rank=Rank.VETERAN,
-        last_rank_change__lt=now() - timedelta(8)
-    ) | ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__guru_xp'] * telegram_multiplier / 10) | Q(activity_counter__lt=60*24 * telegram_multiplier),
-        pk__lt=0,
-        rank=Rank.VETERAN,
-        last_rank_change__lt=now() - timedelta(8)
-    )
-    new_demotes.setdefault(Rank.EXPERIENCED, []).extend(qs)
-    qs.update(
-        rank=Rank.EXPERIENCED,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
+DECAY_RANKS = (Rank.NEWBIE, Rank.JUNIOR, Rank.EXPERIENCED, Rank.VETERAN)
+DECAY_DAYS = 30
 
-    qs = ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__sadhu_xp'] / 20) | Q(activity_counter__lt=60*24),
-        pk__gte=0,
-        rank=Rank.GURU,
-        last_rank_change__lt=now() - timedelta(10)
-    ) | ServerMember.objects.filter(
-        Q(xp__lt=global_preferences['ranks__sadhu_xp'] * telegram_multiplier / 20) | Q(activity_counter__lt=60*24 * telegram_multiplier),
-        pk__lt=0,
-        rank=Rank.GURU,
-        last_rank_change__lt=now() - timedelta(10)
-    )
-    new_demotes.setdefault(Rank.VETERAN, []).extend(qs)
-    qs.update(
-        rank=Rank.VETERAN,
-        last_rank_change=now(),
-        last_forced_activity_update=now()
-    )
+PLATFORMS = (
+    (Q(pk__gte=0), False),
+    (Q(pk__lt=0), True),
+)
 
-    ServerMember.objects\
-        .filter(rank=Rank.NEWBIE, last_forced_activity_update__lt=now() - timedelta(30))\
-        .update(last_forced_activity_update=now(), activity_counter=F('activity_counter') / 2, xp=F('xp') / 2)
 
-    ServerMember.objects\
-        .filter(rank=Rank.JUNIOR, last_forced_activity_update__lt=now() - timedelta(30))\
-        .update(last_forced_activity_update=now(), activity_counter=F('activity_counter') / 2, xp=F('xp') / 2)
-
-    ServerMember.objects\
-        .filter(rank=Rank.EXPERIENCED, last_forced_activity_update__lt=now() - timedelta(30))\
-        .update(last_forced_activity_update=now(), activity_counter=F('activity_counter') / 2, xp=F('xp') / 2)
-
-    ServerMember.objects\
-        .filter(rank=Rank.VETERAN, last_forced_activity_update__lt=now() - timedelta(30))\
-        .update(last_forced_activity_update=now(), activity_counter=F('activity_counter') / 2, xp=F('xp') / 2)
-
-    role_ids = {
+def rank_role_ids():
+    return {
         Rank.NEWBIE: global_preferences['ranks__newbie_role_id'],
         Rank.JUNIOR: global_preferences['ranks__junior_role_id'],
         Rank.EXPERIENCED: global_preferences['ranks__experienced_role_id'],
@@ -276,45 +51,131 @@ def update_ranks():
         Rank.GURU: global_preferences['ranks__guru_role_id'],
     }
 
-    for is_promote, d in ((True, new_promotes), (False, new_demotes)):
-        for rank, members in d.items():
-            if not role_ids[rank]:
-                continue
-            for member in members:  # type: ServerMember
-                member.refresh_from_db(fields=('rank',))
-                if member.pk > 0:
-                    UpdateRoleTask.objects.create(member=member,
-                                                  remove_roles='|'.join(role_ids.values()),
-                                                  add_roles=role_ids[rank])
-                if is_promote:
-                    rank_logger.info('PROMOTE,{},{},{},{}'.format(
-                        member.pk,
-                        member.get_rank_display(),
-                        member.activity_counter,
-                        member.xp
-                    ))
-                    send_discord_message(
-                        global_preferences['ranks__rank_channel'],
-                        '<@{}> has been promoted to rank "{}" (activity: {} hrs, xp: {})'.format(
-                            member.pk,
-                            member.get_rank_display(),
-                            int(member.activity_counter / 60),
-                            member.xp
-                        )
-                    )
-                else:
-                    rank_logger.info('DEMOTE,{},{},{},{}'.format(
-                        member.pk,
-                        member.get_rank_display(),
-                        member.activity_counter,
-                        member.xp
-                    ))
-                    send_discord_message(
-                        global_preferences['ranks__rank_channel'],
-                        '<@{}> has been demoted to rank "{}" (activity: {} hrs, xp: {})'.format(
-                            member.pk,
-                            member.get_rank_display(),
-                            int(member.activity_counter / 60),
-                            member.xp
-                        )
-                    )
+
+def rank_rules(telegram_multiplier, ts):
+    # yields (condition, new rank, spent xp, spent activity, is promote)
+    for platform, is_tg in PLATFORMS:
+        m = telegram_multiplier if is_tg else 1
+        # brand new members need the telegram multiplier on both platforms
+        yield (platform & Q(rank=Rank.BRAND_NEW, xp__gt=0, activity_counter__gte=DAY * telegram_multiplier),
+               Rank.NEWBIE, 0, 0, True)
+        for rank, new_rank, xp_key, days in PROMOTIONS:
+            xp = global_preferences[xp_key] * m
+            activity = DAY * days * m
+            yield (platform & Q(rank=rank, xp__gte=xp, activity_counter__gte=activity),
+                   new_rank, xp, activity, True)
+    for platform, is_tg in PLATFORMS:
+        m = telegram_multiplier if is_tg else 1
+        for rank, new_rank, xp_key, divisor, days in DEMOTIONS:
+            yield (platform & Q(rank=rank, last_rank_change__lt=ts - timedelta(days)) &
+                   (Q(xp__lt=global_preferences[xp_key] * m / divisor) | Q(activity_counter__lt=DAY * m)),
+                   new_rank, 0, 0, False)
+
+
+def apply_rank_changes():
+    # returns (members promoted from brand new, [(member, is promote)] with rank, xp and activity as written)
+    ts = now()
+    rules = list(rank_rules(global_preferences['ranks__telegram_rank_multiplier'], ts))
+    target_rank = Case(*[When(condition, then=Value(i)) for i, (condition, *_) in enumerate(rules)],
+                       default=Value(None), output_field=IntegerField())
+
+    changes = []
+    promoted = []
+    with transaction.atomic():
+        groups = {}
+        members = ServerMember.objects.annotate(rule=target_rank).filter(rule__isnull=False).select_for_update()
+        for member in members:  # type: ServerMember
+            groups.setdefault(member.rule, []).append(member.pk)
+            condition, new_rank, xp, activity, is_promote = rules[member.rule]
+            member.rank = new_rank
+            member.xp -= xp
+            member.activity_counter -= activity
+            changes.append((member, is_promote))
+            if is_promote and new_rank == Rank.NEWBIE:
+                promoted.append(member)
+
+        if groups:
+            ServerMember.objects.filter(pk__in=[member.pk for member, _ in changes]).update(
+                rank=Case(*[When(pk__in=pks, then=Value(rules[i][1])) for i, pks in groups.items()],
+                          output_field=IntegerField()),
+                xp=Case(*[When(pk__in=pks, then=F('xp') - rules[i][2]) for i, pks in groups.items() if rules[i][2]],
+                        default=F('xp'), output_field=DecimalField()),
+                activity_counter=Case(*[When(pk__in=pks, then=F('activity_counter') - rules[i][3])
+                                        for i, pks in groups.items() if rules[i][3]],
+                                      default=F('activity_counter'), output_field=BigIntegerField()),
+                last_rank_change=ts,
+                last_forced_activity_update=ts,
+            )
+            # computedfields does not see queryset updates, refresh the referrers' counters here
+            confirmed = ServerMember.objects.filter(referrer=OuterRef('pk'), rank__gt=Rank.BRAND_NEW).order_by()\
+                .values('referrer').annotate(n=Count('pk')).values('n')
+            ServerMember.objects.filter(pk__in={member.referrer_id for member, _ in changes} - {None}).update(
+                confirmed_referrals=Coalesce(Subquery(confirmed, output_field=IntegerField()), 0)
+            )
+
+        ServerMember.objects\
+            .filter(rank__in=DECAY_RANKS, last_forced_activity_update__lt=ts - timedelta(DECAY_DAYS))\
+            .update(last_forced_activity_update=ts, activity_counter=F('activity_counter') / 2, xp=F('xp') / 2)
+
+        role_ids = rank_role_ids()
+        changes = [(member, is_promote) for member, is_promote in changes if role_ids[member.rank]]
+        UpdateRoleTask.objects.bulk_create([
+            UpdateRoleTask(member=member, remove_roles='|'.join(role_ids.values()), add_roles=role_ids[member.rank])
+            for member, _ in changes if member.pk > 0
+        ])
+        rank_channel = global_preferences['ranks__rank_channel']
+        Notification.objects.bulk_create([
+            Notification(
+                channel=rank_channel,
+                content='<@{}> has been {} to rank "{}" (activity: {} hrs, xp: {})'.format(
+                    member.pk,
+                    'promoted' if is_promote else 'demoted',
+                    member.get_rank_display(),
+                    int(member.activity_counter / 60),
+                    member.xp
+                )
+            ) for member, is_promote in changes if rank_channel
+        ])
+
+    return promoted, changes
+
+
+def pay_referrer_bonuses(sm: ServerMember):
+    referrer = sm.referrer
+    if referrer:
+        lvl1_bonus = global_preferences['ranks__referrer_lvl1_bonus']
+        if lvl1_bonus and global_preferences['general__feeder_balance'] >= lvl1_bonus:
+            global_preferences['general__feeder_balance'] -= lvl1_bonus
+            referrer.adjust(balance=lvl1_bonus)
+            LedgerEntry.post('REFERRER_LVL1', (referrer, 'balance', lvl1_bonus), reference=sm.pk)
+            sm.send_message('You have been awarded {:.8f} for inviting a user (level 1)'.format(lvl1_bonus))
+        if referrer.referrer:
+            lvl2_bonus = global_preferences['ranks__referrer_lvl2_bonus']
+            if lvl2_bonus and global_preferences['general__feeder_balance'] >= lvl2_bonus:
+                global_preferences['general__feeder_balance'] -= lvl2_bonus
+                referrer.referrer.adjust(balance=lvl2_bonus)
+                LedgerEntry.post('REFERRER_LVL2', (referrer.referrer, 'balance', lvl2_bonus), reference=sm.pk)
+                sm.send_message('You have been awarded {:.8f} for inviting a user (level 2)'.format(lvl2_bonus))
+            if referrer.referrer.referrer:
+                lvl3_bonus = global_preferences['ranks__referrer_lvl3_bonus']
+                if lvl3_bonus and global_preferences['general__feeder_balance'] >= lvl3_bonus:
+                    global_preferences['general__feeder_balance'] -= lvl3_bonus
+                    referrer.referrer.referrer.adjust(balance=lvl3_bonus)
+                    LedgerEntry.post('REFERRER_LVL3', (referrer.referrer.referrer, 'balance', lvl3_bonus), reference=sm.pk)
+                    sm.send_message('You have been awarded {:.8f} for inviting a user (level 3)'.format(lvl3_bonus))
+
+
+@app.task(name='app.tasks.update_ranks', base=QueueOnce, once={'graceful': True})
+def update_ranks():
+    promoted, changes = apply_rank_changes()
+    for member in promoted:
+        pay_referrer_bonuses(member)
+
+    for member, is_promote in changes:
+        rank_logger.info('{},{},{},{},{}'.format(
+            'PROMOTE' if is_promote else 'DEMOTE',
+            member.pk,
+            member.get_rank_display(),
+            member.activity_counter,
+            member.xp
+        ))
@@ -1,6 +1,9 @@
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView
 
 from app.models import Masternode
+from app.tasks import check_deposits
 from evosbot.utils import client
 
 
@@ -18,3 +21,15 @@ class MasternodeMonitor(TemplateView):
                 mn.raw = {'status': 'NOT_FOUND'}
         ctx['mns'] = mns
         return ctx
+
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+@csrf_exempt
+def deposit_notify(request):
+    # walletnotify/blocknotify hook: curl -s http://127.0.0.1/notify/deposit/
+    if request.META.get('REMOTE_ADDR') not in LOCAL_ADDRESSES:
+        return HttpResponseForbidden()
+    check_deposits.delay()
+    return HttpResponse()
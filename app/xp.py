@@ -0,0 +1,107 @@
+import json
+from random import randint
+
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from app.models import ServerMember
+from app.presence import redis
+
+# message xp is collected in redis and written in batches, one accumulator per bot
+COOLDOWN_KEY = 'xp:cooldown:{}'
+PENDING_KEY = 'xp:pending:{}'
+NAMES_KEY = 'xp:names:{}'
+FLUSHING = ':flushing'
+UPDATE_BATCH_SIZE = 5000
+XP_FLUSH_INTERVAL = 5
+PROFILE_FIELDS = 'name', 'username', 'avatar'
+
+
+def _profile(value):
+    # profiles used to be stored as [name, username, avatar]
+    if isinstance(value, list):
+        return {field: v for field, v in zip(PROFILE_FIELDS, value) if v is not None}
+    return value
+
+
+class XPAccumulator:
+    def __init__(self, platform):
+        self.pending_key = PENDING_KEY.format(platform)
+        self.names_key = NAMES_KEY.format(platform)
+
+    def award(self, member):
+        # one xp per message of a discord member or telegram user, at most once per 60-120 seconds;
+        # returns whether it was awarded
+        pk, profile = ServerMember.identity(member)
+        r = redis()
+        if not r.set(COOLDOWN_KEY.format(pk), 1, ex=randint(60, 120), nx=True):
+            return False
+        pipe = r.pipeline()
+        pipe.hincrby(self.pending_key, pk, 1)
+        # the latest profile, to create missing members and to sync renames when flushed
+        pipe.hset(self.names_key, pk, json.dumps(profile))
+        pipe.execute()
+        return True
+
+    def take(self):
+        r = redis()
+        pending, names = self.pending_key + FLUSHING, self.names_key + FLUSHING
+        if not r.exists(pending):
+            if not r.exists(self.pending_key):
+                return {}, {}
+            pipe = r.pipeline()
+            pipe.rename(self.pending_key, pending)
+            pipe.rename(self.names_key, names)
+            pipe.execute()
+        return ({int(k): int(v) for k, v in r.hgetall(pending).items()},
+                {int(k): _profile(json.loads(v)) for k, v in r.hgetall(names).items()})
+
+    def release(self):
+        redis().delete(self.pending_key + FLUSHING, self.names_key + FLUSHING)
+
+    def restore(self, xp, names):
+        # puts a released flush back when its transaction did not commit after all
+        pipe = redis().pipeline()
+        for member_id, n in xp.items():
+            pipe.hincrby(self.pending_key, member_id, n)
+        for member_id, profile in names.items():
+            pipe.hsetnx(self.names_key, member_id, json.dumps(profile))
+        pipe.execute()
+
+    def flush(self):
+        # a flush that fails before the release leaves the taken hashes in place and is retried by the next one
+        xp, names = self.take()
+        if not xp:
+            return 0
+        groups = {}
+        for member_id, n in xp.items():
+            groups.setdefault(n, []).append(member_id)
+        released = False
+        try:
+            with transaction.atomic():
+                existing = ServerMember.objects.filter(pk__in=list(xp)).only('pk', *PROFILE_FIELDS).in_bulk()
+                ServerMember.objects.bulk_create([
+                    ServerMember(id=member_id, **profile)
+                    for member_id, profile in names.items() if member_id not in existing
+                ], ignore_conflicts=True)
+                for member_id, sm in existing.items():
+                    if member_id in names:
+                        ServerMember.update_identity(sm, names[member_id], False)
+                ts = now()
+                for n, pks in groups.items():
+                    for i in range(0, len(pks), UPDATE_BATCH_SIZE):
+                        ServerMember.objects.filter(pk__in=pks[i:i + UPDATE_BATCH_SIZE]) \
+                            .update(xp=F('xp') + n, last_message=ts)
+                # released before the commit, so a failure in between loses this flush instead of repeating it
+                self.release()
+                released = True
+        except Exception:
+            if released:
+                self.restore(xp, names)
+            raise
+        return len(xp)
+
+
+discord_xp = XPAccumulator('discord')
+telegram_xp = XPAccumulator('telegram')
@@ -207,7 +207,7 @@ CELERY_BEAT_SCHEDULE = {
     },
     'update_activity': {
         'task': 'app.tasks.update_activity',
-        'schedule': crontab(),
+        'schedule': crontab(minute='*/5'),
     },
     'update_ranks': {
         'task': 'app.tasks.update_ranks',
@@ -233,6 +233,22 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'app.tasks.check_tracked_mns',
         'schedule': crontab(minute='*/5'),
     },
+    'index_blocks': {
+        'task': 'app.tasks.index_blocks',
+        'schedule': crontab(),
+    },
+    'purge_role_tasks': {
+        'task': 'app.tasks.purge_role_tasks',
+        'schedule': crontab(minute='15', hour='3'),
+    },
+    'rollup_masternode_balances': {
+        'task': 'app.tasks.rollup_masternode_balances',
+        'schedule': crontab(minute='*/10'),
+    },
+    'build_candles': {
+        'task': 'app.tasks.build_candles',
+        'schedule': crontab(),
+    },
 }
 CELERY_ONCE = {
     'backend': 'celery_once.backends.Redis',
@@ -2,10 +2,11 @@ from django.contrib import admin
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import path, include
 
-from app.views import MasternodeMonitor
+from app.views import MasternodeMonitor, deposit_notify
 
 urlpatterns = [
     path('mnmonitor/', MasternodeMonitor.as_view(), name='mn_monitor'),
+    path('notify/deposit/', deposit_notify, name='deposit_notify'),
     path('admin/', admin.site.urls),
     path('preferences/', include('dynamic_preferences.urls', namespace='dp')),
 ]
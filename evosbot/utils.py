@@ -1,14 +1,24 @@
+import asyncio
 import io
 import json
 import logging
 import math
-from datetime import datetime, timedelta
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
 from decimal import Decimal
 from enum import Enum
+from queue import LifoQueue, Empty, Full
 
 import requests
 from slickrpc import Proxy
+from slickrpc.aio import AsyncProxy
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from django.utils.timezone import now
+from django_redis import get_redis_connection
 from dynamic_preferences.registries import global_preferences_registry
 from weasyprint import HTML
 
@@ -18,6 +28,15 @@ global_preferences = global_preferences_registry.manager()
 tx_logger = logging.getLogger('tx')
 rank_logger = logging.getLogger('rank')
 
+RPC_POOL_SIZE = 8
+CHAIN_CACHE_SIZE = 4096
+CHAIN_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# seconds between adding the per-process hit counters to the shared ones in redis
+CHAIN_STATS_FLUSH_INTERVAL = 60
+BLOCK_CACHE_CONFIRMATIONS = 10
+MASTERNODE_PRICE_KEY = 'masternode_price'
+MASTERNODE_PRICE_TTL = 60 * 10
+
 
 class Wallet(Enum):
     main = 0
@@ -28,6 +47,176 @@ class Wallet(Enum):
     usernode = 5
 
 
+class RPCPool:
+    def __init__(self, url, size=RPC_POOL_SIZE):
+        self.url = url
+        self.pid = os.getpid()
+        self._idle = LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return Proxy(self.url)
+
+    def release(self, proxy):
+        try:
+            self._idle.put_nowait(proxy)
+        except Full:
+            proxy.conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().conn.close()
+            except Empty:
+                return
+
+
+class PooledProxy:
+    def __init__(self, pool: RPCPool):
+        self._pool = pool
+
+    def __getattr__(self, method):
+        # private and special names are not rpc methods, so copy, pickle and hasattr see plain attribute errors
+        if method.startswith('_'):
+            raise AttributeError(method)
+        pool = self._pool
+
+        def call(*params):
+            proxy = pool.acquire()
+            try:
+                result = getattr(proxy, method)(*params)
+            except RpcException:
+                pool.release(proxy)
+                raise
+            except:
+                # the handle may be left mid-response, do not reuse it
+                proxy.conn.close()
+                raise
+            pool.release(proxy)
+            return result
+        return call
+
+
+class ChainCache:
+    """
+    Decoded transactions and blocks keyed by txid / block hash. Lookups go
+    through a per-process LRU first and the shared django cache (Redis) second.
+    """
+
+    def __init__(self, namespace, size=CHAIN_CACHE_SIZE):
+        self.namespace = namespace
+        self.size = size
+        self.stats = Counter()
+        self._unflushed = Counter()
+        self._flushed_at = time.monotonic()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, kind, key):
+        return 'chain:{}:{}:{}'.format(self.namespace, kind, key)
+
+    @property
+    def stats_key(self):
+        return 'chain:{}:stats'.format(self.namespace)
+
+    def _count(self, **counts):
+        with self._lock:
+            self.stats.update(counts)
+            self._unflushed.update(counts)
+            if time.monotonic() - self._flushed_at < CHAIN_STATS_FLUSH_INTERVAL:
+                return
+            unflushed, self._unflushed = self._unflushed, Counter()
+            self._flushed_at = time.monotonic()
+        try:
+            pipe = get_redis_connection('default').pipeline()
+            for name, n in unflushed.items():
+                pipe.hincrby(self.stats_key, name, n)
+            pipe.execute()
+        except Exception:
+            logging.exception('Could not store chain cache stats')
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > self.size:
+                self._local.popitem(last=False)
+
+    def get_many(self, kind, keys):
+        result = {}
+        missing = {}
+        with self._lock:
+            for key in keys:
+                k = self._key(kind, key)
+                if k in self._local:
+                    self._local.move_to_end(k)
+                    result[key] = self._local[k]
+                else:
+                    missing[k] = key
+        local_hits = len(result)
+        if missing:
+            for k, value in cache.get_many(list(missing)).items():
+                result[missing[k]] = value
+                self._remember(k, value)
+        self._count(local_hits=local_hits, shared_hits=len(result) - local_hits,
+                    misses=len(set(keys) - set(result)))
+        return result
+
+    def get(self, kind, key):
+        return self.get_many(kind, [key]).get(key)
+
+    def set_many(self, kind, values: dict):
+        values = {self._key(kind, key): value for key, value in values.items()}
+        if not values:
+            return
+        cache.set_many(values, CHAIN_CACHE_TIMEOUT)
+        for k, value in values.items():
+            self._remember(k, value)
+
+    def set(self, kind, key, value):
+        self.set_many(kind, {key: value})
+
+    def invalidate(self, kind, key):
+        k = self._key(kind, key)
+        cache.delete(k)
+        with self._lock:
+            self._local.pop(k, None)
+
+    @staticmethod
+    def _rates(stats):
+        lookups = sum(stats.values())
+        return {
+            'hit_rate': (lookups - stats['misses']) / lookups if lookups else 0,
+            'local_hits': stats['local_hits'],
+            'shared_hits': stats['shared_hits'],
+            'misses': stats['misses'],
+        }
+
+    def info(self):
+        # this process only
+        return {'size': len(self._local), **self._rates(self.stats)}
+
+    def shared_info(self):
+        # all processes, up to CHAIN_STATS_FLUSH_INTERVAL behind
+        stats = Counter({k.decode(): int(v) for k, v in get_redis_connection('default').hgetall(self.stats_key).items()})
+        return self._rates(stats)
+
+    def reset_stats(self):
+        get_redis_connection('default').delete(self.stats_key)
+
+
+chain_caches = {
+    'sove': ChainCache('sove'),
+    'bitcoin': ChainCache('bitcoin'),
+}
+
+_rpc_pools = {}
+_rpc_pools_lock = threading.Lock()
+_aio_proxies = {}
+
+
 class RPCClient:
     RPCException = RpcException
 
@@ -49,9 +238,82 @@ class RPCClient:
         elif self.wallet_type == Wallet.usernode:
             return global_preferences['general__usernode_wallet_uri']
 
+    @property
+    def pool(self) -> RPCPool:
+        url = self.rpc_url
+        pool = _rpc_pools.get(self.wallet_type)
+        if pool is not None and pool.url == url and pool.pid == os.getpid():
+            return pool
+        with _rpc_pools_lock:
+            pool = _rpc_pools.get(self.wallet_type)
+            if pool is None or pool.url != url or pool.pid != os.getpid():
+                # handles inherited from the parent process (celery prefork) are dropped, not closed
+                if pool is not None and pool.pid == os.getpid():
+                    pool.close()
+                pool = _rpc_pools[self.wallet_type] = RPCPool(url)
+            return pool
+
     @property
     def api(self):
-        return Proxy(self.rpc_url)
+        return PooledProxy(self.pool)
+
+    @property
+    def aio(self) -> AsyncProxy:
+        # must only be used from the event loop thread
+        url = self.rpc_url
+        proxy_url, proxy = _aio_proxies.get(self.wallet_type, (None, None))
+        if proxy is None or proxy_url != url:
+            if proxy is not None:
+                asyncio.ensure_future(proxy.close())
+            proxy = AsyncProxy(url)
+            _aio_proxies[self.wallet_type] = url, proxy
+        return proxy
+
+    def batch(self, calls):
+        results = self.api.batch(calls)
+        for r in results:
+            if isinstance(r, RpcException):
+                raise r
+        return results
+
+    @property
+    def chain_cache(self) -> ChainCache:
+        return chain_caches['bitcoin' if self.wallet_type == Wallet.bitcoin else 'sove']
+
+    def decode_transactions(self, txids):
+        txids = list(txids)
+        known = self.chain_cache.get_many('tx', txids)
+        missing = list({txid for txid in txids if txid not in known})
+        if missing:
+            raw = self.batch([('getrawtransaction', txid) for txid in missing])
+            decoded = dict(zip(missing, self.batch([('decoderawtransaction', tx_hex) for tx_hex in raw])))
+            self.chain_cache.set_many('tx', decoded)
+            known.update(decoded)
+        return [known[txid] for txid in txids]
+
+    def get_transaction(self, txid):
+        return self.decode_transactions([txid])[0]
+
+    def get_blocks(self, hashes):
+        # blocks are only cached once they are deep enough not to be reorganized away
+        hashes = list(hashes)
+        known = self.chain_cache.get_many('block', hashes)
+        missing = list({bh for bh in hashes if bh not in known})
+        if missing:
+            fetched = dict(zip(missing, self.batch([('getblock', bh) for bh in missing])))
+            self.chain_cache.set_many('block', {
+                bh: b for bh, b in fetched.items() if b.get('confirmations', 0) >= BLOCK_CACHE_CONFIRMATIONS
+            })
+            known.update(fetched)
+        return [known[bh] for bh in hashes]
+
+    def get_block(self, blockhash):
+        return self.get_blocks([blockhash])[0]
+
+    def fill_locked_amounts(self, locked):
+        for l, tx in zip(locked, self.decode_transactions([l['txid'] for l in locked])):
+            l['amount'] = tx['vout'][l['vout']]['value']
+        return locked
 
     def get_balance(self, account='*', minconf=None):
         if minconf is None:
@@ -119,7 +381,13 @@ class RPCClient:
         return self.send_funds_multiple({to: amount})
 
     def estimate_fee(self, conf):
-        fee = self.api.estimatefee(conf)
+        return self._normalize_fee(self.api.estimatefee(conf))
+
+    async def estimate_fee_async(self, conf):
+        return self._normalize_fee(await self.aio.estimatefee(conf))
+
+    @staticmethod
+    def _normalize_fee(fee):
         if fee < 0:
             return Decimal('.0001')
         if fee > 0.1:
@@ -150,85 +418,209 @@ def masternode_address():
     return global_preferences['internal__masternode_address']
 
 
-def get_api_session():
-    api_session = requests.Session()
-    api_session.headers = {'Authorization': 'Bot {}'.format(global_preferences['general__bot_token'])}
-    return api_session
+class DiscordAPI:
+    # one pooled session per process, rate limit buckets are shared by all processes through the cache
+    URL = 'https://discordapp.com/api/v6'
+    GLOBAL_KEY = 'discord:ratelimit:global'
+    MAX_RETRIES = 5
+    MAJOR_PARAMETERS = 'channels', 'guilds', 'webhooks'
+
+    def __init__(self):
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None or self._pid != os.getpid():
+            self._session = requests.Session()
+            self._session.headers['X-RateLimit-Precision'] = 'millisecond'
+            self._pid = os.getpid()
+        self._session.headers['Authorization'] = 'Bot {}'.format(global_preferences['general__bot_token'])
+        return self._session
+
+    @classmethod
+    def route_key(cls, method, path):
+        # ids are stripped except for the major parameter that Discord buckets by
+        parts = path.strip('/').split('/')
+        route = [p if not p.isdigit() or (i and parts[i - 1] in cls.MAJOR_PARAMETERS) else ':id'
+                 for i, p in enumerate(parts)]
+        return 'discord:ratelimit:{}:{}'.format(method, '/'.join(route))
+
+    @staticmethod
+    def retry_after(response):
+        if response.headers.get('X-RateLimit-Reset-After'):
+            return float(response.headers['X-RateLimit-Reset-After'])
+        try:
+            return response.json()['retry_after'] / 1000
+        except (ValueError, KeyError, TypeError):
+            return 1
+
+    @staticmethod
+    def _block(key, seconds):
+        cache.set(key, time.time() + seconds, math.ceil(seconds) + 1)
+
+    def _wait(self, key):
+        blocked_until = max(cache.get_many([self.GLOBAL_KEY, key]).values(), default=0)
+        delay = blocked_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def request(self, method, path, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', 10)
+        key = self.route_key(method, path)
+        for attempt in range(self.MAX_RETRIES):
+            self._wait(key)
+            for f in (kwargs.get('files') or {}).values():
+                if hasattr(f, 'seek'):
+                    f.seek(0)
+            r = self.session.request(method, self.URL + path, **kwargs)
+            if r.headers.get('X-RateLimit-Remaining') == '0':
+                self._block(key, self.retry_after(r))
+            if r.status_code != 429:
+                return r
+            retry_after = self.retry_after(r)
+            logging.warning('Discord rate limit hit on {}, retrying in {:.2f}s'.format(key, retry_after))
+            self._block(self.GLOBAL_KEY if r.headers.get('X-RateLimit-Global') else key, retry_after)
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+
+discord_api = DiscordAPI()
+
+
+ROLE_SNAPSHOT_TTL = 60 * 60 * 24
+
+
+def _role_snapshot_key(user_id):
+    return 'discord:roles:{}'.format(user_id)
+
+
+def get_role_snapshots(user_ids):
+    snapshots = cache.get_many([_role_snapshot_key(user_id) for user_id in user_ids])
+    return {user_id: snapshots[_role_snapshot_key(user_id)] for user_id in user_ids
+            if _role_snapshot_key(user_id) in snapshots}
+
+
+def set_role_snapshots(roles):
+    # roles: {user id: set of role ids as strings}
+    cache.set_many({_role_snapshot_key(user_id): set(r) for user_id, r in roles.items()}, ROLE_SNAPSHOT_TTL)
+
+
+def create_dm_channel(user_id):
+    return discord_api.post('/users/@me/channels', json={'recipient_id': user_id}).json()
 
 
 def send_discord_message(channel, content, file=None):
-    return get_api_session().post('https://discordapp.com/api/v6/channels/{}/messages'.format(channel), {
+    return discord_api.post('/channels/{}/messages'.format(channel), data={
         'payload_json': json.dumps({'content': content})
     }, files={'file': file})
 
 
 def get_member(guild_id, user_id):
-    return get_api_session().get(
-        'https://discordapp.com/api/v6/guilds/{}/members/{}'.format(guild_id, user_id),
-        timeout=5
-    ).json()
+    return discord_api.get('/guilds/{}/members/{}'.format(guild_id, user_id), timeout=5).json()
 
 
 def get_members(guild_id, after=0):
-    return get_api_session().get('https://discordapp.com/api/v6/guilds/{}/members'.format(guild_id),
-                                 params={'limit': 1000, 'after': after}).json()
+    return discord_api.get('/guilds/{}/members'.format(guild_id), params={'limit': 1000, 'after': after}).json()
 
 
 def set_roles(guild_id, user_id, roles):
-    return get_api_session().patch(
-        'https://discordapp.com/api/v6/guilds/{}/members/{}'.format(guild_id, user_id),
-        json={
-            'roles': roles,
-        },
-        timeout=5
-    )
+    return discord_api.patch('/guilds/{}/members/{}'.format(guild_id, user_id), json={
+        'roles': roles,
+    }, timeout=5)
 
 
-def get_masternode_price():
+def _store_masternode_price(price):
+    cache.set(MASTERNODE_PRICE_KEY, (price, now()), MASTERNODE_PRICE_TTL)
+    return price
+
+
+def get_masternode_price(refresh=False):
+    cached = None if refresh else cache.get(MASTERNODE_PRICE_KEY)
+    if cached is not None:
+        return cached[0]
     locked = masternode_client.api.masternode('outputs')
     if not locked:
         raise RuntimeError('Could not get masternode price')
-    tx_hex = masternode_client.api.getrawtransaction(locked[0]['txhash'])
-    decoded = masternode_client.api.decoderawtransaction(tx_hex)
-    return decoded['vout'][locked[0]['outputidx']]['value']
+    decoded = masternode_client.get_transaction(locked[0]['txhash'])
+    return _store_masternode_price(decoded['vout'][locked[0]['outputidx']]['value'])
 
 
-def get_rewards():
-    last_block_hash = client.api.getbestblockhash()
-    block = client.api.getblock(last_block_hash)
-    tx_hex = client.api.getrawtransaction(block['tx'][1])
-    tx = client.api.decoderawtransaction(tx_hex)
+async def get_masternode_price_async():
+    # the cache lookups run in the default executor, they must not block the event loop
+    loop = asyncio.get_event_loop()
+    cached = await loop.run_in_executor(None, cache.get, MASTERNODE_PRICE_KEY)
+    if cached is not None:
+        return cached[0]
+    locked = await masternode_client.aio.masternode('outputs')
+    if not locked:
+        raise RuntimeError('Could not get masternode price')
+    txid = locked[0]['txhash']
+    decoded = await loop.run_in_executor(None, masternode_client.chain_cache.get, 'tx', txid)
+    if decoded is None:
+        tx_hex = await masternode_client.aio.getrawtransaction(txid)
+        decoded = await masternode_client.aio.decoderawtransaction(tx_hex)
+        await loop.run_in_executor(None, masternode_client.chain_cache.set, 'tx', txid, decoded)
+    return await loop.run_in_executor(None, _store_masternode_price, decoded['vout'][locked[0]['outputidx']]['value'])
+
+
+def masternode_price_updated_at():
+    cached = cache.get(MASTERNODE_PRICE_KEY)
+    return cached[1] if cached is not None else None
+
 
-    inputs = 0
-    for txin in tx['vin']:
-        input_tx = client.api.decoderawtransaction(client.api.getrawtransaction(txin['txid']))
-        inputs += input_tx['vout'][txin['vout']]['value']
+def invalidate_masternode_price():
+    cache.delete(MASTERNODE_PRICE_KEY)
 
-    pos_reward = sum(vout['value'] for vout in tx['vout'][1:-1]) - inputs
-    mn_reward = tx['vout'][-1]['value']
 
-    return pos_reward, mn_reward
+def get_blocks_rewards(rpc_client: RPCClient, blocks):
+    coinstakes = rpc_client.decode_transactions(b['tx'][1] for b in blocks if len(b['tx']) >= 2)
+    input_txids = list({txin['txid'] for tx in coinstakes for txin in tx['vin']})
+    input_txs = dict(zip(input_txids, rpc_client.decode_transactions(input_txids)))
+
+    coinstakes = iter(coinstakes)
+    rewards = []
+    for block in blocks:
+        if len(block['tx']) < 2:
+            rewards.append((None, None))
+            continue
+        tx = next(coinstakes)
+        inputs = sum(input_txs[txin['txid']]['vout'][txin['vout']]['value'] for txin in tx['vin'])
+        pos_reward = sum(vout['value'] for vout in tx['vout'][1:-1]) - inputs
+        mn_reward = tx['vout'][-1]['value']
+        rewards.append((pos_reward, mn_reward))
+    return rewards
+
+
+def get_rewards():
+    last_block_hash = client.api.getbestblockhash()
+    return get_blocks_rewards(client, [client.get_block(last_block_hash)])[0]
 
 
 def send_stats(channel=None):
-    from app.models import OrderLog, Masternode, UserNode
+    from app.models import Candle, Masternode, UserNode, BlockIndex
 
-    lo = OrderLog.objects.last()
-    last_deal = lo.btc_price if lo else 0
+    last_deal = Candle.last_price()
+    day_volume = Candle.summary(now() - timedelta(1))['volume'] or 0
     block_count = client.api.getblockcount()
     total_masternodes = max(m['rank'] for m in client.api.masternode('list'))
     shared_masternodes = Masternode.objects.filter(active=True).count()
     user_masternodes = UserNode.objects.filter(pending=False, active=True).count()
     masternode_price = get_masternode_price()
-    last_day_blocks = 0
-    last_block_hash = client.api.getbestblockhash()
-    while True:
-        block = client.api.getblock(last_block_hash)
-        if datetime.fromtimestamp(block['time']) < datetime.now() - timedelta(1):
-            break
-        last_day_blocks += 1
-        last_block_hash = block['previousblockhash']
-    pos_reward, mn_reward = get_rewards()
+    last_day_blocks = BlockIndex.objects.filter(time__gte=now() - timedelta(1)).count()
+    last_reward = BlockIndex.objects.filter(mn_reward__isnull=False).order_by('-height').first()
+    if last_reward:
+        pos_reward, mn_reward = last_reward.pos_reward, last_reward.mn_reward
+    else:
+        pos_reward, mn_reward = get_rewards()
     amroi = last_day_blocks * mn_reward * 365 / masternode_price / total_masternodes * 100
     pool_balance = masternode_client.get_balance()
     stack_median = global_preferences['internal__stack_median']
@@ -244,6 +636,7 @@ def send_stats(channel=None):
         'pool_balance': pool_balance,
         'stack_median': stack_median,
         'last_deal': last_deal,
+        'day_volume': day_volume,
     })
     png = io.BytesIO(HTML(string=html).write_png())
     png.name = 'stats.png'
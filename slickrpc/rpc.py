@@ -45,6 +45,30 @@ def EncodeDecimal(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 
+def batch_payload(calls, ids):
+    return [{"jsonrpc": "2.0",
+             "method": method,
+             "params": params,
+             "id": id} for id, (method, params) in zip(ids, calls)]
+
+
+def batch_results(resp, calls, ids):
+    if isinstance(resp, dict):
+        raise RpcException(resp.get('error') or {'code': -32700, 'message': 'Unexpected response'},
+                           'batch', calls)
+    by_id = {r.get('id'): r for r in resp}
+    results = []
+    for id, (method, params) in zip(ids, calls):
+        r = by_id.get(id)
+        if r is None:
+            results.append(RpcException({'code': -32603, 'message': 'Missing response'}, method, params))
+        elif r.get('error') is not None:
+            results.append(RpcException(r['error'], method, params))
+        else:
+            results.append(r['result'])
+    return results
+
+
 class Proxy(object):
     _ids = count(0)
 
@@ -53,15 +77,7 @@ class Proxy(object):
                  service_port=None,
                  conf_file=None,
                  timeout=DEFAULT_HTTP_TIMEOUT):
-        config = dict()
-        if conf_file:
-            config = ConfigObj(conf_file)
-        if service_url:
-            config.update(self.url_to_conf(service_url))
-        if service_port:
-            config.update(rpcport=service_port)
-        elif not config.get('rpcport'):
-            config['rpcport'] = DEFAULT_RPC_PORT
+        config = self.load_config(service_url, service_port, conf_file)
         self.conn = self.prepare_connection(config, timeout=timeout)
 
     def __getattr__(self, method):
@@ -82,6 +98,27 @@ class Proxy(object):
             return resp['result']
         return call
 
+    def batch(self, calls):
+        """
+        Send several calls in a single JSON-RPC batch request.
+
+        `calls` is a sequence of (method, *params) tuples. Results are returned
+        in the same order; a failed call yields an RpcException instance in
+        its place instead of raising.
+        """
+        calls = [(call[0], tuple(call[1:])) for call in calls]
+        if not calls:
+            return []
+        conn = self.conn
+        ids = [next(self._ids) for _ in calls]
+        postdata = json.dumps(batch_payload(calls, ids), default=EncodeDecimal)
+        body = StringIO()
+        conn.setopt(conn.WRITEFUNCTION, body.write)
+        conn.setopt(conn.POSTFIELDS, postdata)
+        conn.perform()
+        resp = json.loads(body.getvalue(), parse_float=decimal.Decimal)
+        return batch_results(resp, calls, ids)
+
     @classmethod
     def prepare_connection(cls, conf, timeout=DEFAULT_HTTP_TIMEOUT):
         url = 'http://%s:%s' % (conf['rpchost'], conf['rpcport'])
@@ -96,8 +133,22 @@ class Proxy(object):
         conn.setopt(conn.TIMEOUT, timeout)
         conn.setopt(conn.URL, url)
         conn.setopt(conn.POST, 1)
+        conn.setopt(conn.TCP_KEEPALIVE, 1)
         return conn
 
+    @classmethod
+    def load_config(cls, service_url=None, service_port=None, conf_file=None):
+        config = dict()
+        if conf_file:
+            config = ConfigObj(conf_file)
+        if service_url:
+            config.update(cls.url_to_conf(service_url))
+        if service_port:
+            config.update(rpcport=service_port)
+        elif not config.get('rpcport'):
+            config['rpcport'] = DEFAULT_RPC_PORT
+        return config
+
     @classmethod
     def url_to_conf(cls, service_url):
         url = urlparse.urlparse(service_url)